@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+# vim: fileencoding=utf8
+"""Microbenchmarks for the parsing and dispatch hot paths of Flask-IRC.
+
+Every benchmark runs one operation over a corpus of realistic inputs and
+reports the time per operation as well as the objects and bytes retained
+per operation (i.e. the size of the results and of anything cached). The
+results are compared against a stored baseline; a slowdown or memory
+growth above the threshold is reported as a regression and makes the
+script exit with status 1. Times are the fastest of several interleaved
+runs and suspected slowdowns are measured again, so a busy machine does
+not cause false alarms.
+
+    python benchmarks/run.py                  # run and compare
+    python benchmarks/run.py --save-baseline  # store the results as baseline
+    python benchmarks/run.py -k lookup        # only run matching benchmarks
+"""
+
+import argparse
+import gc
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from flask_irc.bot import _BotCommand
+from flask_irc.structs import CommandStorage, IRCMessage, IRCSource, MaskSet, PatternSet
+from flask_irc.utils import convert_formatting, to_unicode
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+SEED = 4711
+
+_WORDS = ('playlist', 'queue', 'user', 'channel', 'ban', 'add', 'remove', 'list', 'show',
+          'set', 'get', 'info', 'stats', 'reload', 'search', 'karma', 'quote', 'topic',
+          'mode', 'op', 'voice', 'kick', 'remind', 'weather', 'seen', 'tell', 'config',
+          'module', 'admin', 'help')
+# The same texts in the encodings clients actually send
+_TEXTS = (u'hello world, anyone around?',
+          u'Gr\xfc\xdfe aus M\xfcnchen — wie geht’s?',
+          u'“quoted” text from a windows client',
+          u'caf\xe9 cr\xe8me br\xfbl\xe9e',
+          u'\x02bold\x02 and \x0304,01colored\x03 text with \x1funderline\x1f',
+          u'!playlist add https://example.com/watch?v=abc123 --position 3',
+          u'日本語のテキスト',
+          u'foo++ bar-- http://example.org/some/long/path?with=query&and=more')
+_ENCODINGS = ('utf-8', 'utf-8', 'utf-8', 'windows-1252', 'iso-8859-15')
+
+
+def _encode(rng, text):
+    for codec in rng.sample(_ENCODINGS, len(_ENCODINGS)):
+        try:
+            return text.encode(codec)
+        except UnicodeEncodeError:
+            pass
+    return text.encode('utf-8')
+
+
+def _nick(rng):
+    return '%s%s%d' % (rng.choice(('', '[', '_')), rng.choice(_WORDS), rng.randint(0, 9999))
+
+
+def _source(rng):
+    nick = _nick(rng)
+    host = rng.choice(('host-%d.dsl.example.net' % rng.randint(0, 99999),
+                       '192.168.%d.%d' % (rng.randint(0, 255), rng.randint(0, 255)),
+                       'user/%s' % nick.strip('[_'),
+                       '2001:db8::%x' % rng.randint(0, 0xffff)))
+    return '%s!%s%s@%s' % (nick, rng.choice(('', '~')), nick[:10], host)
+
+
+def make_lines(rng, count=2000):
+    """Raw lines as received from a server, in various encodings"""
+    lines = []
+    for i in xrange(count):
+        kind = rng.random()
+        text = _encode(rng, rng.choice(_TEXTS))
+        if kind < 0.6:
+            line = ':%s PRIVMSG #%s :%s' % (_source(rng), rng.choice(_WORDS), text)
+        elif kind < 0.75:
+            line = ('@time=2024-01-01T12:00:%02d.000Z;msgid=%x;batch=ref%d :%s PRIVMSG '
+                    '#%s :%s' % (i % 60, rng.getrandbits(64), i % 3, _source(rng),
+                                 rng.choice(_WORDS), text))
+        elif kind < 0.85:
+            line = ':%s %s #%s' % (_source(rng), rng.choice(('JOIN', 'PART')),
+                                   rng.choice(_WORDS))
+        elif kind < 0.95:
+            line = ':%s QUIT :hub.example.net leaf%d.example.net' % (_source(rng), i % 5)
+        else:
+            line = 'PING :irc%d.example.net' % (i % 10)
+        lines.append(line)
+    return lines
+
+
+def make_names_replies(rng, users=5000):
+    """NAMES replies of a large channel, split into lines like servers do"""
+    lines = []
+    prefix = ':irc.example.net 353 FlaskBot = #bigchannel :'
+    names = []
+    for i in xrange(users):
+        name = rng.choice(('', '', '', '+', '@', '@+')) + _nick(rng)
+        if len(prefix) + len(' '.join(names + [name])) > 510:
+            lines.append(prefix + ' '.join(names))
+            names = []
+        names.append(name)
+    lines.append(prefix + ' '.join(names))
+    return lines
+
+
+def make_commands(rng, count=400):
+    """A deep set of multi-word commands and lines looking them up"""
+    storage = CommandStorage()
+    names = []
+    while len(names) < count:
+        name = ' '.join(rng.choice(_WORDS) for i in xrange(rng.randint(1, 4)))
+        if name not in storage:
+            storage[name] = name
+            names.append(name)
+    lookups = []
+    for i in xrange(2000):
+        if rng.random() < 0.8:
+            args = ' '.join(rng.choice(_WORDS) for j in xrange(rng.randint(0, 3)))
+            lookups.append(('%s %s' % (rng.choice(names), args)).strip())
+        else:
+            lookups.append('unknown%d %s' % (i, rng.choice(_WORDS)))
+    return storage, lookups
+
+
+def make_bot_commands(rng):
+    def simple(source, channel, nick):
+        """Shows information about a user."""
+        return 'Info about $b%s$b' % nick
+
+    def options(source, channel, name, count='10', verbose=False):
+        """Lists things.
+
+        Lists up to 'count' things matching a name.
+        """
+        for i in xrange(3):
+            yield '$c04%s$c %d %s' % (name, i, verbose)
+
+    def greedy(source, channel, target, message):
+        """Sends a message."""
+        return u'%s → %s' % (target, message)
+
+    commands = [(_BotCommand(None, 'info', simple, False), lambda: [_nick(rng)]),
+                (_BotCommand(None, 'list', options, False),
+                 lambda: [rng.choice(_WORDS), '--count', '5', '-v']),
+                (_BotCommand(None, 'tell', greedy, True),
+                 lambda: [_nick(rng)] + rng.choice(_TEXTS).split())]
+    calls = []
+    for i in xrange(600):
+        cmd, make_args = commands[i % len(commands)]
+        calls.append((cmd, make_args()))
+    return calls
+
+
+def make_masks(rng, count=5000):
+    masks = MaskSet()
+    for i in xrange(count):
+        kind = i % 5
+        if kind == 0:
+            masks.add('*!*@host-%d.dsl.example.net' % rng.randint(0, 99999))
+        elif kind == 1:
+            masks.add('*!*@*.isp%d.example.com' % i)
+        elif kind == 2:
+            masks.add('*!*@192.168.%d.*' % rng.randint(0, 255))
+        elif kind == 3:
+            masks.add('%s!*@*' % _nick(rng))
+        elif i % 50 == 4:
+            masks.add('*%s*!*@*' % rng.choice(_WORDS)) # needs the general bucket
+    sources = [_source(rng) for i in xrange(5000)]
+    return masks, sources
+
+
+def make_patterns():
+    patterns = PatternSet()
+    patterns.add(r'https?://\S+', 'url')
+    patterns.add(r'(\w+)(\+\+|--)', 'karma')
+    patterns.add(r'\bbeer\b', 'beer', re.I)
+    patterns.add(r'^!(\w+)', 'bang')
+    return patterns
+
+
+def get_benchmarks():
+    """Returns `(name, operation, items)` tuples"""
+    rng = random.Random(SEED)
+    lines = make_lines(rng)
+    names = make_names_replies(rng)
+    sources = [_source(rng) for i in xrange(2000)]
+    raw_texts = [_encode(rng, rng.choice(_TEXTS)) for i in xrange(2000)]
+    formatted = [u'$b%s$b: $c04%s$c $u%s$u' % (_nick(rng), rng.choice(_TEXTS), rng.choice(_WORDS))
+                 for i in xrange(2000)]
+    storage, lookups = make_commands(rng)
+    calls = make_bot_commands(rng)
+    masks, mask_sources = make_masks(rng)
+    patterns = make_patterns()
+    texts = [IRCMessage(line)[-1] for line in lines if ' PRIVMSG ' in line]
+    return [
+        ('IRCMessage (mixed lines)', IRCMessage, lines),
+        ('IRCMessage (NAMES replies)', IRCMessage, names),
+        ('IRCSource', IRCSource, sources),
+        ('to_unicode', to_unicode, raw_texts),
+        ('convert_formatting', convert_formatting, formatted),
+        ('CommandStorage.lookup', storage.lookup, lookups),
+        ('_BotCommand.__call__', lambda call: call[0](None, '#chan', call[1]), calls),
+        ('MaskSet.match', masks.match, mask_sources),
+        ('PatternSet.match', patterns.match, texts),
+    ]
+
+
+def calibrate(func, items, run_time):
+    """Returns how often to loop over the items to run for about `run_time`"""
+    loops = 1
+    while _run(func, items, loops) < run_time:
+        loops *= 2
+    return loops
+
+
+def measure_times(benchmarks, min_time, repeat):
+    """Returns the fastest time per operation of each benchmark.
+
+    The benchmarks are run in `repeat` interleaved rounds, so a phase in
+    which the machine is busy slows down one run of several benchmarks
+    rather than all runs of one benchmark.
+    """
+    loops = [calibrate(func, items, float(min_time) / repeat)
+             for name, func, items in benchmarks]
+    best = [None] * len(benchmarks)
+    for i in xrange(repeat):
+        for j, (name, func, items) in enumerate(benchmarks):
+            elapsed = _run(func, items, loops[j]) / (loops[j] * len(items))
+            best[j] = elapsed if best[j] is None else min(best[j], elapsed)
+    return best
+
+
+def _run(func, items, loops):
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = timeit.default_timer()
+        for i in xrange(loops):
+            for item in items:
+                func(item)
+        return timeit.default_timer() - start
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def measure_memory(func, items):
+    """Returns the objects and bytes retained per operation.
+
+    Objects tracked by the garbage collector which are new after running
+    the operation over all items are counted, so temporary objects are not
+    included. Strings and numbers are not tracked; their size is included
+    if they are a result or referenced by a new object.
+    """
+    func(items[0]) # warm up caches of the interpreter
+    gc.collect()
+    before = set(id(obj) for obj in gc.get_objects())
+    results = [func(item) for item in items]
+    gc.collect()
+    objects = gc.get_objects()
+    new = [obj for obj in objects
+           if id(obj) not in before and obj is not objects and obj is not results]
+    del objects
+    seen = set()
+    size = 0
+    for obj in itertools.chain(new, results):
+        for item in [obj] + [ref for ref in gc.get_referents(obj) if not gc.is_tracked(ref)]:
+            if id(item) not in seen:
+                seen.add(id(item))
+                size += sys.getsizeof(item)
+    count = float(len(items))
+    return len(new) / count, size / count
+
+
+def _regressed(value, base, threshold):
+    # Differences below one object or byte per operation are noise
+    return value > base * (1 + threshold) and value - base >= 1
+
+
+def regressions(results, baseline, threshold, memory_threshold):
+    """Returns the names of the benchmarks which regressed"""
+    names = []
+    for name, seconds, objects, size in results:
+        base = baseline.get(name)
+        if base and (seconds > base['time'] * (1 + threshold) or
+                     _regressed(objects, base.get('objects', objects), memory_threshold) or
+                     _regressed(size, base.get('memory', size), memory_threshold)):
+            names.append(name)
+    return names
+
+
+def report(results, baseline, regressed):
+    print '%-28s %12s %10s %10s %10s' % ('benchmark', 'time/op', 'objects/op', 'bytes/op',
+                                         'change')
+    for name, seconds, objects, size in results:
+        base = baseline.get(name)
+        change = '%+.1f%%' % ((seconds / base['time'] - 1) * 100) if base else ''
+        status = '  REGRESSION' if name in regressed else ''
+        print '%-28s %10.2fus %10.2f %10.0f %10s%s' % (name, seconds * 1e6, objects, size,
+                                                      change, status)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the Flask-IRC microbenchmarks.')
+    parser.add_argument('-k', dest='filter', help='only run benchmarks containing this string')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline file')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results in the baseline file')
+    parser.add_argument('--threshold', type=float, default=0.3,
+                        help='allowed slowdown before reporting a regression (default: 0.3)')
+    parser.add_argument('--memory-threshold', type=float, default=0.25,
+                        help='allowed growth of the retained objects and bytes (default: 0.25)')
+    parser.add_argument('--min-time', type=float, default=1.0,
+                        help='approximate seconds spent per benchmark (default: 1)')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='number of interleaved runs per benchmark (default: 10)')
+    args = parser.parse_args()
+
+    benchmarks = [(name, func, items) for name, func, items in get_benchmarks()
+                  if not args.filter or args.filter.lower() in name.lower()]
+    memory = [measure_memory(func, items) for name, func, items in benchmarks]
+    times = measure_times(benchmarks, args.min_time, args.repeat)
+    results = [(name, seconds, objects, size) for (name, func, items), seconds, (objects, size)
+               in zip(benchmarks, times, memory)]
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    elif not args.save_baseline:
+        print 'No baseline found at %s; run with --save-baseline to create one.\n' % args.baseline
+    regressed = regressions(results, baseline, args.threshold, args.memory_threshold)
+    if regressed and not args.save_baseline:
+        # Measure suspected regressions again to rule out a busy machine
+        retry = [benchmark for benchmark in benchmarks if benchmark[0] in regressed]
+        retimes = dict(zip(regressed, measure_times(retry, args.min_time, args.repeat)))
+        results = [(name, min(seconds, retimes.get(name, seconds)), objects, size)
+                   for name, seconds, objects, size in results]
+        regressed = regressions(results, baseline, args.threshold, args.memory_threshold)
+    report(results, baseline, regressed)
+
+    if args.save_baseline:
+        for name, seconds, objects, size in results:
+            baseline[name] = {'time': seconds, 'objects': objects, 'memory': size}
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print '\nBaseline saved to %s' % args.baseline
+        return 0
+    if regressed:
+        print '\n%d benchmark(s) regressed: %s' % (len(regressed), ', '.join(regressed))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
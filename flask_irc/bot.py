@@ -1,30 +1,52 @@
 # vim: fileencoding=utf8
 
 import argparse
+import collections
 import errno
+import imp
 import importlib
 import inspect
 import itertools
+import json
+import os
+import pkgutil
 import pyev
+import Queue
+import re
 import signal
 import socket
+import ssl
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import werkzeug.exceptions
-from datetime import datetime
-
-from .structs import CommandStorage, IRCMessage
+import zlib
+
+from . import handoff, ipc
+from .history import HistoryStore
+from .iolog import IOLogger
+from .servers import Server, ServerPool, parse_server
+from .state import StateStore, StateWriter
+from .structs import (CommandStorage, IRCMessage, MaskSet, PatternSet, TokenBuckets,
+    TTLCache, Future)
 from .utils import to_unicode, trim_docstring, convert_formatting
 
-try:
-    from termcolor import cprint, colored
-except ImportError:
-    def cprint(msg, *args, **kwargs):
-        print msg
-    def colored(msg, *args, **kwargs):
-        return msg
-
 NONBLOCKING = (errno.EAGAIN, errno.EWOULDBLOCK)
 STOPSIGNALS = {signal.SIGINT: 'SIGINT', signal.SIGTERM: 'SIGTERM'}
+# Queued commands are not run while more output than this is pending
+OUTPUT_BACKLOG = 8192
+# Maximum length of a line sent to the server, excluding CRLF
+MAX_LINE_LENGTH = 510
+# IRCv3 capabilities requested if the server supports them
+WANTED_CAPS = set(('batch',))
+# Maximum size of the data waiting to be sent to a worker process
+WORKER_BACKLOG = 1024 * 1024
+# Commands sent to a single worker when partitioning by channel
+ROUTED_COMMANDS = ('PRIVMSG', 'NOTICE', 'JOIN', 'PART', 'KICK', 'MODE', 'TOPIC')
+# The quit message of users lost in a netsplit, e.g. "hub.example.net leaf.example.net"
+NETSPLIT_RE = re.compile(r'^\S+\.\S+ \S+\.\S+$')
 # Event types; used in the Bot._events dict
 CONNECT = 'connect'
 DISCONNECT = 'disconnect'
@@ -39,6 +61,10 @@ UNLOAD = 'unload'
 MOD_EVENTS = BOT_EVENTS + (INIT, RELOAD, UNLOAD)
 # Events that are relayed to all modules
 COMMON_EVENTS = tuple(set(MOD_EVENTS) - set((BEFORE_COMMAND,)))
+# Events relayed from the gateway to the worker processes
+WORKER_EVENTS = (CONNECT, DISCONNECT, READY, TERMINATE)
+# Marker for missing cache entries since None is a valid command output
+_MISSING = object()
 
 module_list = {}
 
@@ -47,23 +73,75 @@ class Bot(object):
         self._logger_name = logger_name
         self.nick = None
         self.server = None
+        self.isupport = {}
+        self.channels = set()
+        self.caps = set()
         self.ready = False
+        self.lag = None # seconds until the server answered our last PING
+        self._userhost = None # our "user@host" as seen by others
         self.loop = None
         self.sock = None
         self.watcher = None
         self._stop_loop = False
+        self._ssl_context = None
+        self._handshaking = False
+        self._ssl_blocked = False # an SSL operation waits for another event
+        self._current_server = None
+        self._connect_addrs = [] # addresses of the current server not tried yet
+        self._connect_sock = None # socket while connecting
+        self._resolving = None # server whose addresses are being resolved
+        self._connect_watcher = None
+        self._ping_sent = None
+        self._ping_token = None
         self._writebuf = ''
         self._readbuf = ''
+        self._queued_bytes = 0 # total bytes added to _writebuf
+        self._written_bytes = 0 # total bytes sent from _writebuf
+        self._deliveries = collections.deque() # (byte offset, future) tuples
+        self._threadsafe_queue = collections.deque()
+        self._async = None # wakes up the loop; calls are buffered until it exists
         self._handlers = {} # irc events (numerics/commands)
+        self._batch_handlers = {} # irc events delivered in bursts
+        self._available_caps = set()
+        self._batches = {} # open IRCv3 batches
+        self._burst = [] # messages waiting to be delivered to batch handlers
+        self._burst_started = None
         self._events = {} # special events (disconnect etc.)
         self._timers = []
         self.modules = {}
+        self.state_writer = None
+        self._state_dir = None
+        self.history = None
+        self.ignores = MaskSet() # users whose messages do not trigger commands
+        self._handoff_listener = None
         self._commands = CommandStorage()
+        self._patterns = PatternSet()
+        self._ratelimit = None
+        self._cmd_queue = collections.OrderedDict() # queued commands per user
+        self._throttled = set()
+        self._lazy_modules = {} # registered modules which are not imported yet
+        self._lazy_events = {} # irc events triggering the import of lazy modules
+        self._lazy_commands = CommandStorage() # commands of lazy modules -> module name
+        self._workers = [] # worker processes running the modules
+        self._worker_id = None # index of this process if it is a worker
+        self._frame_reader = None
         # Internal handlers
         self.on('ERROR')(self._handle_error)
         self.on('PING')(self._handle_ping)
+        self.on('PONG')(self._handle_pong)
         self.on('001')(self._handle_welcome)
+        self.on('005')(self._handle_isupport)
+        self.on('NICK')(self._handle_nick)
+        self.on('JOIN')(self._handle_join)
+        self.on('PART')(self._handle_part)
+        self.on('KICK')(self._handle_kick)
+        self.on('CAP')(self._handle_cap)
+        self.on('BATCH')(self._handle_batch)
         self.on('PRIVMSG')(self._handle_privmsg)
+        self.on('PRIVMSG')(self._handle_patterns)
+        self.on('PRIVMSG')(self._handle_history)
+        self._internal_handlers = dict((cmd, list(handlers))
+            for cmd, handlers in self._handlers.iteritems())
         if app is not None:
             self.app = app
             self.init_app(self.app)
@@ -76,14 +154,69 @@ class Bot(object):
         app.config.setdefault('IRC_SERVER_HOST', '127.0.0.1')
         app.config.setdefault('IRC_SERVER_PORT', 6667)
         app.config.setdefault('IRC_SERVER_PASS', None)
+        app.config.setdefault('IRC_SERVERS', [])
+        app.config.setdefault('IRC_CONNECT_TIMEOUT', 10)
+        app.config.setdefault('IRC_PING_INTERVAL', 60)
+        app.config.setdefault('IRC_PING_TIMEOUT', 120)
+        app.config.setdefault('IRC_SERVER_SSL', False)
+        app.config.setdefault('IRC_SSL_VERIFY', True)
+        app.config.setdefault('IRC_SSL_CA_CERTS', None)
+        app.config.setdefault('IRC_SSL_CERTFILE', None)
+        app.config.setdefault('IRC_SSL_KEYFILE', None)
         app.config.setdefault('IRC_NICK', 'FlaskBot')
         app.config.setdefault('IRC_USER', 'FlaskBot')
         app.config.setdefault('IRC_REALNAME', 'FlaskBot')
         app.config.setdefault('IRC_TRIGGER', None)
+        app.config.setdefault('IRC_IGNORE', [])
         app.config.setdefault('IRC_RECONNECT_DELAY', 2)
         app.config.setdefault('IRC_DEBUG', False)
+        app.config.setdefault('IRC_IO_LOG_FILE', None)
+        app.config.setdefault('IRC_IO_LOG_BUFFER', 10000)
         app.config.setdefault('IRC_MODULES', [])
+        app.config.setdefault('IRC_MODULE_REGISTRY', {})
+        app.config.setdefault('IRC_MODULE_PREWARM', True)
+        app.config.setdefault('IRC_RATE_LIMIT_BURST', 0) # 0 disables rate limiting
+        app.config.setdefault('IRC_RATE_LIMIT_RATE', 0.5)
+        app.config.setdefault('IRC_RATE_LIMIT_USERS', 1000)
+        app.config.setdefault('IRC_RATE_LIMIT_QUEUE', 3)
+        app.config.setdefault('IRC_RESPONSE_CACHE_SIZE', 1000)
+        app.config.setdefault('IRC_THREADSAFE_QUEUE_SIZE', 10000)
+        app.config.setdefault('IRC_THREADSAFE_BATCH', 100)
+        app.config.setdefault('IRC_STATE_DIR', None)
+        app.config.setdefault('IRC_STATE_SAVE_INTERVAL', 5)
+        app.config.setdefault('IRC_STATE_COMPACT_SIZE', 1024 * 1024)
+        app.config.setdefault('IRC_HANDOFF_SOCKET', None)
+        app.config.setdefault('IRC_HANDOFF_TIMEOUT', 60)
+        app.config.setdefault('IRC_BURST_WINDOW', 0.25)
+        app.config.setdefault('IRC_BURST_MAX_DELAY', 2)
+        app.config.setdefault('IRC_WORKERS', 0)
+        app.config.setdefault('IRC_WORKER_PARTITION', 'module')
+        app.config.setdefault('IRC_HISTORY_SIZE', 0)
+        app.config.setdefault('IRC_HISTORY_DIR', None)
+        app.config.setdefault('IRC_HISTORY_SEGMENT_SIZE', 16 * 1024 * 1024)
+        app.config.setdefault('IRC_HISTORY_SEGMENTS', 8)
+        app.config.setdefault('IRC_PROFILE_DIR', None) # defaults to the temp dir
+        app.config.setdefault('IRC_PROFILE_MAX_DURATION', 300) # 0 disables the limit
+        app.config.setdefault('IRC_PROFILE_MEM_CHUNK', 10000) # 0 measures at once
+        self.module_registry = app.config['IRC_MODULE_REGISTRY']
         self._init_logger()
+        if app.config['IRC_SERVERS']:
+            servers = [parse_server(entry) for entry in app.config['IRC_SERVERS']]
+        else:
+            servers = [Server(app.config['IRC_SERVER_HOST'], app.config['IRC_SERVER_PORT'])]
+        self.servers = ServerPool(servers)
+        self._response_cache = TTLCache(app.config['IRC_RESPONSE_CACHE_SIZE'])
+        self.io_log = IOLogger(app.config['IRC_IO_LOG_BUFFER'],
+            app.config['IRC_IO_LOG_FILE'])
+        self._init_history(app.config['IRC_HISTORY_DIR'])
+        for mask in app.config['IRC_IGNORE']:
+            self.ignores.add(mask)
+
+    def _init_history(self, spill_dir):
+        config = self.app.config
+        if config['IRC_HISTORY_SIZE']:
+            self.history = HistoryStore(config['IRC_HISTORY_SIZE'], spill_dir,
+                config['IRC_HISTORY_SEGMENT_SIZE'], config['IRC_HISTORY_SEGMENTS'])
 
     def _init_logger(self):
         if not self._logger_name:
@@ -91,32 +224,536 @@ class Bot(object):
         else:
             self.logger = self.app.logger.getChild(self._logger_name)
 
-    def _log_io(self, direction, line):
-        if not self.app.config['IRC_DEBUG'] or not sys.stdout.isatty():
+    def _init_io_log(self):
+        if not self.app.config['IRC_DEBUG']:
             return
-        now = datetime.now()
-        ts = now.strftime('%Y-%m-%d %H:%M:%S')
-        prefix = '[%s,%03d]' % (ts, now.microsecond / 1000)
-        if direction == 'in':
-            print prefix, colored('<< %s' % line, 'blue', attrs=['bold'])
-        elif direction == 'out':
-            print prefix, colored('>> %s' % line, 'green')
+        if not self.io_log.filename and not sys.stdout.isatty():
+            return
+        self.io_log.enable()
+        self.io_log.start()
 
     def run(self):
         """Start the bot and its event loop"""
+        self._init_io_log()
         self.loop = pyev.default_loop()
-        self.loop.debug = self.app.debug
-        delay = self.app.config['IRC_RECONNECT_DELAY']
-        self._reconnect_tmr = pyev.Timer(delay, delay, self.loop, self._reconnect_cb)
-        for name in self.app.config['IRC_MODULES']:
-            self.load_module(name)
+        self._init_loop()
+        use_workers = bool(self.app.config['IRC_WORKERS'])
+        if not use_workers:
+            self._init_state(self.app.config['IRC_STATE_DIR'])
+        # When taking over a connection from another process, do so before
+        # loading the modules to get their most recent state
+        handoff_path = os.environ.pop(handoff.HANDOFF_ENV, None)
+        resumed = self._resume_connection(handoff_path) if handoff_path else None
+        if not use_workers:
+            self._load_modules(self.app.config['IRC_MODULES'])
         self.logger.info('Starting event loop')
-        self._connect()
+        if resumed is not None:
+            if self.nick:
+                self._registered()
+            self._trigger_event(CONNECT)
+            if resumed['ready']:
+                self.trigger_ready()
+        else:
+            self._connect()
+        if use_workers:
+            self._start_workers()
         self._sigwatchers = [pyev.Signal(sig, self.loop, self._sig_cb)
             for sig in STOPSIGNALS.iterkeys()]
+        self._sigwatchers.append(pyev.Signal(signal.SIGUSR2, self.loop, self._upgrade_sig_cb))
         for watcher in self._sigwatchers:
             watcher.start()
         self.loop.start()
+        self._stop_workers()
+        if self.state_writer is not None:
+            self.save_state()
+            self.state_writer.stop()
+        if self.history is not None:
+            self.history.close()
+        self.io_log.stop()
+
+    def _init_loop(self):
+        self.loop.debug = self.app.debug
+        delay = self.app.config['IRC_RECONNECT_DELAY']
+        self._reconnect_tmr = pyev.Timer(delay, delay, self.loop, self._reconnect_cb)
+        self._connect_tmr = pyev.Timer(self.app.config['IRC_CONNECT_TIMEOUT'], 0, self.loop,
+            self._connect_timeout_cb)
+        self._init_ratelimit()
+        self._async = pyev.Async(self.loop, self._async_cb)
+        self._async.start()
+        if self._threadsafe_queue:
+            # Calls made before the loop existed
+            self._async.send()
+        self._burst_tmr = pyev.Timer(self.app.config['IRC_BURST_WINDOW'], 0, self.loop,
+            self._burst_cb)
+        self._init_keepalive()
+
+    def _init_keepalive(self):
+        interval = self.app.config['IRC_PING_INTERVAL']
+        timeout = self.app.config['IRC_PING_TIMEOUT']
+        self._keepalive_tmr = self._ping_timeout_tmr = None
+        if interval:
+            self._keepalive_tmr = pyev.Timer(interval, interval, self.loop, self._keepalive_cb)
+        if timeout:
+            self._ping_timeout_tmr = pyev.Timer(timeout, 0, self.loop, self._ping_timeout_cb)
+
+    def _keepalive_cb(self, watcher, revents):
+        if self.nick is None or self._ping_sent is not None:
+            return # not registered yet or still waiting for a PONG
+        self._ping_sent = time.time()
+        self._ping_token = 'LAG%d' % (self._ping_sent * 1000)
+        self.send('PING :%s' % self._ping_token)
+        self._start_ping_timeout()
+
+    def _start_ping_timeout(self):
+        if self._ping_timeout_tmr is not None:
+            self._ping_timeout_tmr.stop()
+            self._ping_timeout_tmr.start()
+
+    def _ping_timeout_cb(self, watcher, revents):
+        self.logger.warn('No response from server within %ds; reconnecting' %
+            self.app.config['IRC_PING_TIMEOUT'])
+        self._close()
+        self._reconnect()
+
+    def _stop_keepalive(self):
+        for timer in (self._keepalive_tmr, self._ping_timeout_tmr):
+            if timer is not None:
+                timer.stop()
+        self._ping_sent = None
+        self.lag = None
+
+    def _load_modules(self, names):
+        for name in names:
+            if name not in module_list and self._is_lazy(name):
+                self._add_lazy_module(name)
+            else:
+                self.load_module(name)
+
+    def _start_workers(self):
+        """Runs the modules in worker processes.
+
+        This process only talks to the IRC server. It forwards the received
+        lines to the workers and sends their output to the server. Modules
+        are either distributed among the workers (IRC_WORKER_PARTITION set
+        to 'module') or every worker runs all modules and receives the
+        messages of some channels ('channel'). In the latter case timers and
+        events not related to a channel only run in the first worker.
+        """
+        # Commands are handled by the workers
+        self._handlers['PRIVMSG'].remove(self._handle_privmsg)
+        self._handlers['PRIVMSG'].remove(self._handle_patterns)
+        self._handlers['PRIVMSG'].remove(self._handle_history)
+        self.history = None
+        self._spawn_workers(self.app.config['IRC_WORKERS'])
+
+    def _spawn_workers(self, count):
+        self._workers = [None] * count
+        for index in xrange(count):
+            self._spawn_worker(index)
+
+    def _spawn_worker(self, index):
+        sock, child_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            sock.close()
+            status = 1
+            try:
+                self._run_worker(index, child_sock)
+                status = 0
+            except Exception:
+                self.logger.exception('Worker %d failed' % index)
+            finally:
+                os._exit(status)
+        child_sock.close()
+        sock.setblocking(0)
+        worker = _Worker(index, pid, sock)
+        worker.watcher = pyev.Io(sock, pyev.EV_READ, self.loop, self._worker_cb, worker)
+        worker.watcher.start()
+        self._workers[index] = worker
+        self.logger.info('Started worker %d (pid %d)' % (index, pid))
+        if self.watcher is not None and not self._handshaking:
+            # Started while connected; bring the worker up to date
+            self._send_worker(worker, ipc.FRAME_STATE, json.dumps(self._connection_state()))
+            self._send_worker(worker, ipc.FRAME_EVENT, CONNECT)
+            if self.ready:
+                self._send_worker(worker, ipc.FRAME_EVENT, READY)
+
+    def _stop_workers(self):
+        # Closing the sockets makes the workers stop once they processed
+        # everything sent to them
+        workers = [worker for worker in self._workers if worker is not None]
+        self._workers = []
+        for worker in workers:
+            worker.watcher.stop()
+            try:
+                worker.sock.setblocking(1)
+                worker.sock.sendall(worker.writebuf)
+            except socket.error:
+                pass
+            worker.sock.close()
+        for worker in workers:
+            try:
+                os.waitpid(worker.pid, 0)
+            except OSError:
+                pass
+
+    def _worker_cb(self, watcher, revents):
+        worker = watcher.data
+        if revents & pyev.EV_READ:
+            try:
+                buf = worker.sock.recv(65536)
+            except socket.error, e:
+                buf = None if e.args[0] in NONBLOCKING else ''
+            if buf == '':
+                self._worker_lost(worker)
+                return
+            if buf:
+                for frame_type, payload in worker.reader.feed(buf):
+                    self._handle_worker_frame(frame_type, payload)
+        if revents & pyev.EV_WRITE and self._workers[worker.index] is worker:
+            try:
+                num = worker.sock.send(worker.writebuf)
+            except socket.error, e:
+                if e.args[0] not in NONBLOCKING:
+                    self._worker_lost(worker)
+                return
+            worker.writebuf = worker.writebuf[num:]
+            if not worker.writebuf:
+                watcher.stop()
+                watcher.set(watcher.fd, pyev.EV_READ)
+                watcher.start()
+
+    def _worker_lost(self, worker):
+        worker.watcher.stop()
+        worker.sock.close()
+        self._workers[worker.index] = None
+        try:
+            os.kill(worker.pid, signal.SIGTERM)
+        except OSError:
+            pass
+        try:
+            os.waitpid(worker.pid, 0)
+        except OSError:
+            pass
+        delay = self.app.config['IRC_RECONNECT_DELAY']
+        self.logger.error('Worker %d (pid %d) died; restarting it in %ds' % (
+            worker.index, worker.pid, delay))
+        self.after(delay, lambda: self._respawn_worker(worker.index))
+
+    def _respawn_worker(self, index):
+        # The workers may have been stopped or replaced in the meantime
+        if index < len(self._workers) and self._workers[index] is None:
+            self._spawn_worker(index)
+
+    def _send_worker(self, worker, frame_type, payload=''):
+        if worker is None:
+            return # being restarted
+        if len(worker.writebuf) >= WORKER_BACKLOG:
+            if not worker.dropped:
+                self.logger.warn('Worker %d is not keeping up; dropping messages' %
+                    worker.index)
+            worker.dropped += 1
+            return
+        if not worker.writebuf:
+            worker.watcher.stop()
+            worker.watcher.set(worker.watcher.fd, pyev.EV_READ | pyev.EV_WRITE)
+            worker.watcher.start()
+        worker.dropped = 0
+        worker.writebuf += ipc.pack_frame(frame_type, payload)
+
+    def _forward_line(self, line, msg):
+        index = self._route(msg)
+        if index is not None and msg.cmd in ROUTED_COMMANDS and not self._changes_channels(msg):
+            self._send_worker(self._workers[index], ipc.FRAME_LINE, line)
+        else:
+            # Every worker keeps track of the connection state; the modules
+            # only handle the message in the worker it is routed to
+            for worker in self._workers:
+                self._send_worker(worker, ipc.FRAME_LINE, line)
+
+    def _route(self, msg):
+        """Returns the index of the worker whose modules handle a message
+
+        None is returned if the modules of all workers handle it, i.e. if
+        the modules are not partitioned by channel."""
+        if self.app.config['IRC_WORKER_PARTITION'] != 'channel':
+            return None
+        if msg.cmd in ROUTED_COMMANDS and msg.args:
+            target = msg[0]
+            if target[:1] in self.isupport.get('CHANTYPES', '#&'):
+                return _worker_index(target.lower(), self.app.config['IRC_WORKERS'])
+            elif msg.cmd in ('PRIVMSG', 'NOTICE') and msg.source.nick:
+                # Private messages are partitioned by sender
+                return _worker_index(msg.source.nick.lower(), self.app.config['IRC_WORKERS'])
+        return 0
+
+    def _changes_channels(self, msg):
+        """Whether a message changes the channels the bot is in"""
+        if msg.cmd in ('JOIN', 'PART'):
+            return msg.source.nick == self.nick
+        return msg.cmd == 'KICK' and len(msg.args) > 1 and msg[1] == self.nick
+
+    def _runs_global_tasks(self):
+        """Whether timers and events not related to a channel run in this process"""
+        return (self._worker_id in (None, 0) or
+                self.app.config['IRC_WORKER_PARTITION'] != 'channel')
+
+    def _handle_worker_frame(self, frame_type, payload):
+        if frame_type == ipc.FRAME_SEND:
+            if self.watcher is None or self._handshaking:
+                return # not connected; the output is lost like during a disconnect
+            for line in payload.splitlines():
+                self.io_log.log('out', line)
+            self._send_raw(payload)
+        elif frame_type == ipc.FRAME_STOP:
+            self.stop(payload == '1')
+        elif frame_type == ipc.FRAME_UPGRADE:
+            self.hot_upgrade()
+
+    def _run_worker(self, index, sock):
+        """Runs the event loop of a worker process"""
+        # Signals are handled by the gateway; it stops the workers by closing
+        # their sockets
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        # Stop using anything inherited from the gateway
+        for worker in self._workers:
+            if worker is not None:
+                worker.sock.close()
+        if self.sock is not None:
+            self.sock.close()
+        if self._handoff_listener is not None:
+            self._handoff_sock.close()
+            self._handoff_listener = None
+        self._workers = []
+        self._worker_id = index
+        self._timers = []
+        self.io_log = IOLogger(self.app.config['IRC_IO_LOG_BUFFER'])
+        # Every worker records the messages it receives
+        spill_dir = self.app.config['IRC_HISTORY_DIR']
+        self._init_history(spill_dir and os.path.join(spill_dir, 'worker-%d' % index))
+        # Handlers answering the server only run in the gateway; handlers
+        # and events of the application itself as well, except for access
+        # checks of commands.
+        self._handlers = dict((cmd, [handler for handler in handlers
+                                     if handler not in (self._handle_error, self._handle_ping,
+                                                        self._handle_cap)])
+                              for cmd, handlers in self._internal_handlers.iteritems())
+        self._batch_handlers = {}
+        self._events = {BEFORE_COMMAND: self._events.get(BEFORE_COMMAND, [])}
+        self.loop = pyev.Loop()
+        self._init_loop()
+        state_dir = self.app.config['IRC_STATE_DIR']
+        if state_dir and self.app.config['IRC_WORKER_PARTITION'] == 'channel':
+            # Every worker runs all modules, each with the state of its channels
+            state_dir = os.path.join(state_dir, 'worker-%d' % index)
+        self._init_state(state_dir)
+        self.sock = sock
+        sock.setblocking(0)
+        self._frame_reader = ipc.FrameReader()
+        self.watcher = pyev.Io(sock, pyev.EV_READ, self.loop, self._gateway_cb)
+        self.watcher.start()
+        names = self.app.config['IRC_MODULES']
+        if self.app.config['IRC_WORKER_PARTITION'] != 'channel':
+            count = self.app.config['IRC_WORKERS']
+            names = [name for name in names if _worker_index(name, count) == index]
+        self._load_modules(names)
+        self.loop.start()
+        if self.state_writer is not None:
+            self.save_state()
+            self.state_writer.stop()
+        if self.history is not None:
+            self.history.close()
+
+    def _gateway_cb(self, watcher, revents):
+        if revents & pyev.EV_READ:
+            try:
+                buf = self.sock.recv(65536)
+            except socket.error, e:
+                buf = None if e.args[0] in NONBLOCKING else ''
+            if buf == '':
+                # The gateway has stopped
+                self.loop.stop(pyev.EVBREAK_ALL)
+                return
+            if buf:
+                for frame_type, payload in self._frame_reader.feed(buf):
+                    self._handle_gateway_frame(frame_type, payload)
+        if revents & pyev.EV_WRITE:
+            self._io_write()
+
+    def _handle_gateway_frame(self, frame_type, payload):
+        if frame_type == ipc.FRAME_LINE:
+            self._parse_line(payload)
+        elif frame_type == ipc.FRAME_EVENT:
+            if payload == READY:
+                self.trigger_ready()
+            elif payload == DISCONNECT:
+                self._reset_connection()
+            else:
+                self._trigger_event(payload)
+        elif frame_type == ipc.FRAME_STATE:
+            self._restore_state(json.loads(payload))
+
+    def hot_upgrade(self, argv=None):
+        """Hands the IRC connection over to a new process.
+
+        The new process is started with the given argv (defaulting to the
+        current command line) and takes over the socket and connection
+        state, so the IRC server does not notice the restart. This process
+        stops once the handoff has succeeded.
+        """
+        if self._worker_id is not None:
+            self._write(ipc.pack_frame(ipc.FRAME_UPGRADE))
+            return True
+        if self.sock is None or self._handoff_listener is not None:
+            return False
+        if isinstance(self.sock, ssl.SSLSocket):
+            # The TLS session state cannot be passed to another process
+            self.logger.error('Hot upgrades are not possible on TLS connections')
+            return False
+        path = self.app.config['IRC_HANDOFF_SOCKET']
+        if not path:
+            path = os.path.join(tempfile.gettempdir(), 'flask-irc-%d.sock' % os.getpid())
+        self._handoff_sock = handoff.listen(path)
+        self._handoff_path = path
+        self._handoff_listener = pyev.Io(self._handoff_sock, pyev.EV_READ, self.loop,
+            self._handoff_cb)
+        self._handoff_listener.start()
+        self._handoff_tmr = pyev.Timer(self.app.config['IRC_HANDOFF_TIMEOUT'], 0, self.loop,
+            self._handoff_timeout_cb)
+        self._handoff_tmr.start()
+        if argv is None:
+            argv = [sys.executable] + sys.argv
+        env = dict(os.environ)
+        env[handoff.HANDOFF_ENV] = path
+        self.logger.info('Starting new process for hot upgrade')
+        subprocess.Popen(argv, env=env, close_fds=True)
+        return True
+
+    def _handoff_cb(self, watcher, revents):
+        conn, _ = self._handoff_sock.accept()
+        self._stop_handoff()
+        address = self._current_server.address if self._current_server else None
+        state = dict(self._connection_state(), readbuf=self._readbuf,
+            writebuf=self._writebuf, address=address, lag=self.lag)
+        # Stop using the socket; the new process may start reading immediately
+        self.watcher.stop()
+        if self.state_writer is not None:
+            self.save_state()
+            self.state_writer.flush()
+        # Workers save their state when stopping
+        worker_count = len(self._workers)
+        self._stop_workers()
+        try:
+            success = handoff.send_connection(conn, self.sock, state)
+        except Exception:
+            self.logger.exception('Hot upgrade failed')
+            success = False
+        finally:
+            conn.close()
+        if not success:
+            self.watcher.start()
+            if worker_count:
+                self._spawn_workers(worker_count)
+            return
+        self.logger.info('Connection handed over to new process; terminating')
+        # The pending output is sent by the new process
+        while self._deliveries:
+            self._deliveries.popleft()[1].set_result(True)
+        self.watcher = None
+        self.sock.close()
+        self.sock = None
+        self.loop.stop(pyev.EVBREAK_ALL)
+
+    def _handoff_timeout_cb(self, watcher, revents):
+        self.logger.error('Hot upgrade failed: new process did not connect')
+        self._stop_handoff()
+
+    def _stop_handoff(self):
+        self._handoff_tmr.stop()
+        self._handoff_listener.stop()
+        self._handoff_listener = None
+        self._handoff_sock.close()
+        os.unlink(self._handoff_path)
+
+    def _resume_connection(self, path):
+        try:
+            sock, state = handoff.receive_connection(path)
+        except Exception:
+            self.logger.exception('Could not take over connection')
+            return None
+        sock.setblocking(0)
+        self.sock = sock
+        self._restore_state(state)
+        # The server is unknown if it has been removed from the config
+        address = state.get('address')
+        self._current_server = next((server for server in self.servers
+                                     if server.address == address), None)
+        self.lag = state.get('lag')
+        if self._current_server is not None and self.lag is not None:
+            self.servers.record_lag(self._current_server, self.lag)
+        self._readbuf = state['readbuf']
+        self._writebuf = state['writebuf']
+        self._queued_bytes = len(self._writebuf)
+        self._written_bytes = 0
+        events = pyev.EV_READ | (pyev.EV_WRITE if self._writebuf else 0)
+        self.watcher = pyev.Io(sock, events, self.loop, self._io_cb)
+        self.watcher.start()
+        if self._keepalive_tmr is not None:
+            self._keepalive_tmr.start()
+        self.logger.info('Took over connection to %s with nick %s' % (self.server, self.nick))
+        return state
+
+    def _connection_state(self):
+        return {'nick': self.nick, 'server': self.server, 'isupport': self.isupport,
+                'channels': list(self.channels), 'caps': list(self.caps),
+                'ready': self.ready}
+
+    def _restore_state(self, state):
+        self.nick = state['nick']
+        self.server = state['server']
+        self.isupport = state['isupport']
+        self.channels = set(state['channels'])
+        self.caps = set(state['caps'])
+
+    def _upgrade_sig_cb(self, watcher, revents):
+        self.logger.info('Received signal SIGUSR2; starting hot upgrade')
+        self.hot_upgrade()
+
+    def _init_state(self, state_dir):
+        if not state_dir:
+            return
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        self._state_dir = state_dir
+        self.state_writer = StateWriter()
+        self.state_writer.start()
+        interval = self.app.config['IRC_STATE_SAVE_INTERVAL']
+        self._state_tmr = pyev.Timer(interval, interval, self.loop, self._save_state_cb)
+        self._state_tmr.start()
+
+    def _create_state_store(self, module):
+        if self.state_writer is None:
+            return None
+        return StateStore(self._state_dir, module.name, self.state_writer,
+            module.logger, self.app.config['IRC_STATE_COMPACT_SIZE'])
+
+    def save_state(self):
+        """Saves the changed state of all persistent modules"""
+        for module in self.modules.itervalues():
+            module.save_state()
+
+    def _save_state_cb(self, watcher, revents):
+        self.save_state()
+
+    def _init_ratelimit(self):
+        burst = self.app.config['IRC_RATE_LIMIT_BURST']
+        if not burst:
+            return
+        self._ratelimit = TokenBuckets(burst, self.app.config['IRC_RATE_LIMIT_RATE'],
+            self.app.config['IRC_RATE_LIMIT_USERS'])
+        self._cmd_queue_tmr = pyev.Timer(0.25, 0.25, self.loop, self._cmd_queue_cb)
 
     def stop(self, graceful=True):
         """Stop the bot and its event loop.
@@ -124,7 +761,10 @@ class Bot(object):
         If the graceful flag is set, the write queue is flushed before
         the event loop is stopped.
         """
-        if not graceful:
+        if self._worker_id is not None:
+            self._write(ipc.pack_frame(ipc.FRAME_STOP, '1' if graceful else ''))
+            return
+        if not graceful or self.watcher is None:
             self.loop.stop()
         else:
             self.watcher.stop()
@@ -135,8 +775,17 @@ class Bot(object):
     def send(self, line):
         """Send a line to the IRC server"""
         line = line.encode('utf-8')
-        self._log_io('out', line)
-        self._writebuf += line + '\r\n'
+        self.io_log.log('out', line)
+        self._send_raw(line + '\r\n')
+
+    def _send_raw(self, data):
+        if self._worker_id is not None:
+            data = ipc.pack_frame(ipc.FRAME_SEND, data)
+        self._write(data)
+
+    def _write(self, data):
+        self._writebuf += data
+        self._queued_bytes += len(data)
         self.watcher.stop()
         self.watcher.set(self.watcher.fd, self.watcher.events | pyev.EV_WRITE)
         self.watcher.start()
@@ -145,10 +794,123 @@ class Bot(object):
         for item in data:
             self.send(fmt % (item or ' '))
 
-    def on(self, cmd):
-        """A decorator to register a handler for an IRC command"""
+    def announce(self, targets, lines, notice=False):
+        """Sends lines to many channels/users using as few messages as possible.
+
+        The targets are combined into comma-separated lists as long as the
+        server allows it (TARGMAX/MAXTARGETS) and the line length permits.
+        """
+        cmd = 'NOTICE' if notice else 'PRIVMSG'
+        max_targets = self._get_max_targets(cmd)
+        targets = [target.encode('utf-8') for target in targets]
+        data = []
+        for line in lines:
+            text = line.encode('utf-8')
+            # Length of everything besides the targets, i.e. "CMD  :text"
+            # and the prefix the server adds when relaying the message
+            budget = MAX_LINE_LENGTH - self._prefix_length() - len(cmd) - len(text) - 3
+            for group in _pack_targets(targets, budget, max_targets):
+                line = '%s %s :%s' % (cmd, ','.join(group), text)
+                self.io_log.log('out', line, cmd)
+                data.append(line)
+        if data:
+            self._send_raw('\r\n'.join(data) + '\r\n')
+
+    def _prefix_length(self):
+        """Returns the length of ":nick!user@host " as relayed by the server"""
+        if self._userhost is not None:
+            userhost = len(self._userhost)
+        else:
+            # Not known before joining a channel; assume the longest one.
+            # The user name may get a "~" prepended.
+            userhost = (int(self.isupport.get('USERLEN') or 10) + 2 +
+                        int(self.isupport.get('HOSTLEN') or 63))
+        return len(self.nick or '') + userhost + 3
+
+    def _get_max_targets(self, cmd):
+        targmax = self.isupport.get('TARGMAX')
+        if targmax is not None:
+            limits = dict(item.partition(':')[::2] for item in targmax.split(','))
+            if cmd in limits:
+                # An empty limit means there is no limit
+                return int(limits[cmd]) if limits[cmd] else None
+        maxtargets = self.isupport.get('MAXTARGETS')
+        if maxtargets:
+            return int(maxtargets)
+        return 1
+
+    def call_soon_threadsafe(self, func, *args):
+        """Calls a function in the event loop thread.
+
+        This method may be called from any thread. It returns a future which
+        receives the return value of the function. If too many calls are
+        pending, Queue.Full is raised.
+        """
+        future = Future()
+        self._enqueue_threadsafe(func, args, future)
+        return future
+
+    def send_threadsafe(self, line):
+        """Sends a line to the IRC server from any thread.
+
+        The returned future receives True once the line has been written to
+        the socket or an exception if it could not be sent. If too many calls
+        are pending, Queue.Full is raised.
+        """
+        future = Future()
+        self._enqueue_threadsafe(self._send_confirmed, (line, future), None)
+        return future
+
+    def _enqueue_threadsafe(self, func, args, future):
+        # deque.append is atomic so no lock is needed
+        if len(self._threadsafe_queue) >= self.app.config['IRC_THREADSAFE_QUEUE_SIZE']:
+            raise Queue.Full('Too many pending calls')
+        self._threadsafe_queue.append((func, args, future))
+        # Appending first ensures the call is not missed if the loop is
+        # being set up right now
+        if self._async is not None:
+            self._async.send()
+
+    def _send_confirmed(self, line, future):
+        if self.watcher is None:
+            future.set_exception(socket.error('Not connected'))
+            return
+        try:
+            self.send(line)
+        except Exception, e:
+            future.set_exception(e)
+        else:
+            self._deliveries.append((self._queued_bytes, future))
+
+    def _async_cb(self, watcher, revents):
+        # Only run a limited number of calls at once to keep handling
+        # socket events while other threads keep adding calls.
+        for i in xrange(self.app.config['IRC_THREADSAFE_BATCH']):
+            try:
+                func, args, future = self._threadsafe_queue.popleft()
+            except IndexError:
+                break
+            try:
+                result = func(*args)
+            except Exception, e:
+                self.logger.exception('Error in threadsafe call to %r' % func)
+                if future is not None:
+                    future.set_exception(e)
+            else:
+                if future is not None:
+                    future.set_result(result)
+        if self._threadsafe_queue:
+            self._async.send()
+
+    def on(self, cmd, batch=False):
+        """A decorator to register a handler for an IRC command
+
+        If the batch flag is set, the handler is called with a list of
+        messages. Messages arriving in bursts, e.g. QUITs during a netsplit,
+        are collected and delivered together."""
+        handlers = self._batch_handlers if batch else self._handlers
         def decorator(f):
-            self._handlers.setdefault(cmd, []).append(f)
+            handlers.setdefault(cmd, []).append(f)
             return f
         return decorator
 
@@ -183,22 +945,85 @@ class Bot(object):
 
     def load_module(self, name):
         """Loads a module"""
+        if name in self._lazy_modules:
+            return self._activate_lazy_module(name)
+        if name not in module_list and name in self.module_registry:
+            if not self._import_module(name):
+                return False
         if name not in module_list or name in self.modules:
             return False
         module_list[name].init_bot(self)
         return True
 
+    def _import_module(self, name):
+        import_name = self.module_registry[name]['import_name']
+        try:
+            importlib.import_module(import_name)
+        except Exception:
+            self.logger.exception('Could not import module %s from %s' % (name, import_name))
+            return False
+        if name not in module_list:
+            self.logger.error('Module %s was not found in %s' % (name, import_name))
+            return False
+        return True
+
+    def _is_lazy(self, name):
+        # Modules are only imported lazily if we know what triggers the import
+        entry = self.module_registry.get(name)
+        return entry is not None and bool(entry.get('commands') or entry.get('events'))
+
+    def _add_lazy_module(self, name):
+        entry = self.module_registry[name]
+        for cmd in entry.get('commands', []):
+            self._lazy_commands[cmd] = name
+        for evt in entry.get('events', []):
+            self._lazy_events.setdefault(evt, set()).add(name)
+        self._lazy_modules[name] = entry
+        self.logger.debug('Registered lazy module %s' % name)
+
+    def _activate_lazy_module(self, name):
+        entry = self._lazy_modules.pop(name)
+        for cmd in entry.get('commands', []):
+            del self._lazy_commands[cmd]
+        for evt in entry.get('events', []):
+            names = self._lazy_events[evt]
+            names.discard(name)
+            if not names:
+                del self._lazy_events[evt]
+        try:
+            return self.load_module(name)
+        except ValueError:
+            # e.g. the module's name or commands collide with a loaded module
+            self.logger.exception('Could not activate lazy module %s' % name)
+            return False
+
+    def _prewarm(self, names):
+        # Runs in a separate thread; only imports the modules so activating them
+        # in the event loop is cheap.
+        for name in names:
+            if name not in module_list:
+                self._import_module(name)
+        self.call_soon_threadsafe(self._activate_prewarmed)
+
+    def _activate_prewarmed(self):
+        for name in list(self._lazy_modules):
+            if name in module_list:
+                self._activate_lazy_module(name)
+
     def _register_module(self, module):
         if module.name in self.modules:
             msg = 'A module named %s is already registered' % module.name
             raise ValueError(msg)
-        if any(cmd in self._commands for cmd in module._commands):
+        if any(cmd in self._commands or cmd in self._lazy_commands
+               for cmd in module._commands):
             msg = 'The module %s contains a command colliding with an existing command' % (
                 module.name)
             raise ValueError(msg)
         self.modules[module.name] = module
         for cmd, func in module._commands.iteritems():
             self._commands[cmd] = func
+        for pattern, flags, func in module._matchers:
+            self._patterns.add(pattern, (module, func), flags)
         self.logger.debug('Registered module %s' % module.name)
 
     def _unregister_module(self, module):
@@ -209,11 +1034,22 @@ class Bot(object):
         # Remove module's commands
         for cmd, func in module._commands.iteritems():
             del self._commands[cmd]
+        self.invalidate_cache(module)
+        # Remove module's message patterns
+        for pattern, flags, func in module._matchers:
+            self._patterns.remove(pattern, (module, func), flags)
         # Stop module's timers
         for watcher in module._timers:
             watcher.stop()
         self.logger.debug('Unregistered module %s' % module.name)
 
+    def invalidate_cache(self, module, command=None):
+        """Removes cached command responses of a module or a single command"""
+        key = (str(module),)
+        if command is not None:
+            key += (command,)
+        self._response_cache.discard_prefix(key)
+
     def trigger_ready(self):
         """Triggers the 'ready' event"""
         if not self.ready:
@@ -228,12 +1064,90 @@ class Bot(object):
     def _handle_ping(self, msg):
         self.send('PONG :%s' % msg[0])
 
+    def _handle_pong(self, msg):
+        if self._ping_sent is None or msg.args[-1] != self._ping_token:
+            return
+        self.lag = time.time() - self._ping_sent
+        self._ping_sent = None
+        if self._ping_timeout_tmr is not None:
+            self._ping_timeout_tmr.stop()
+        if self._current_server is not None:
+            self.servers.record_lag(self._current_server, self.lag)
+
     def _handle_welcome(self, msg):
         self.server = str(msg.source)
         self.nick = msg[0]
+        if self._ping_timeout_tmr is not None:
+            # Registration succeeded; stop waiting for it
+            self._ping_timeout_tmr.stop()
         self.logger.info('Connected to %s with nick %s' % (self.server, self.nick))
+        self._registered()
+
+    def _registered(self):
+        """Called once registration succeeded or a connection was taken over"""
+        if self._current_server is not None:
+            self.servers.success(self._current_server)
+        if self._lazy_modules and self.app.config['IRC_MODULE_PREWARM']:
+            thread = threading.Thread(target=self._prewarm, name='flask-irc-prewarm',
+                args=(list(self._lazy_modules),))
+            thread.daemon = True
+            thread.start()
+
+    def _handle_isupport(self, msg):
+        # The first argument is our nick, the last one a human-readable text
+        for token in msg.args[1:-1]:
+            if token.startswith('-'):
+                self.isupport.pop(token[1:], None)
+            else:
+                key, _, value = token.partition('=')
+                self.isupport[key] = value
+
+    def _handle_nick(self, msg):
+        if msg.source.nick == self.nick:
+            self.nick = msg[0]
+
+    def _handle_join(self, msg):
+        if msg.source.nick == self.nick:
+            self.channels.add(msg[0].lower())
+            if msg.source.complete:
+                self._userhost = '%s@%s' % (msg.source.ident, msg.source.host)
+
+    def _handle_part(self, msg):
+        if msg.source.nick == self.nick:
+            self.channels.discard(msg[0].lower())
+
+    def _handle_kick(self, msg):
+        if msg[1] == self.nick:
+            self.channels.discard(msg[0].lower())
+
+    def _handle_cap(self, msg):
+        subcmd = msg[1]
+        if subcmd == 'LS':
+            # Capabilities may have values, e.g. "sasl=PLAIN"
+            self._available_caps.update(cap.partition('=')[0] for cap in msg.args[-1].split())
+            if len(msg.args) > 3 and msg[2] == '*':
+                return # more capabilities follow
+            wanted = WANTED_CAPS & self._available_caps
+            if wanted:
+                self.send('CAP REQ :%s' % ' '.join(sorted(wanted)))
+            else:
+                self.send('CAP END')
+        elif subcmd in ('ACK', 'NAK'):
+            if subcmd == 'ACK':
+                self.caps.update(msg.args[-1].split())
+            if not self.nick:
+                self.send('CAP END')
+
+    def _handle_batch(self, msg):
+        ref = msg[0]
+        if ref[0] == '+':
+            self._batches[ref[1:]] = []
+        elif ref[0] == '-':
+            self._deliver_batch(self._batches.pop(ref[1:], []))
 
     def _handle_privmsg(self, msg):
+        if self.ignores and self.ignores.match(msg.source):
+            return
         line = msg[1]
         if msg[0] == self.nick:
             channel = None
@@ -248,51 +1162,206 @@ class Bot(object):
         except ValueError, e:
             self.send('NOTICE %s :%s' % (msg.source.nick, e))
             return
+        if self._lazy_commands:
+            name, lazy_args = self._lazy_commands.lookup(line.strip())
+            # The longest matching command wins, as within a single storage
+            if name is not None and (cmd is None or len(lazy_args) < len(args)):
+                self._activate_lazy_module(name)
+                cmd, args = self._commands.lookup(line.strip())
         if cmd:
-            base_url = self.app.config.get('BASE_URL')
-            with self.app.app_context():
-                with self.app.test_request_context(base_url=base_url):
-                    self._run_command(msg, channel, cmd, args)
+            self._schedule_command(msg, channel, cmd, args)
+
+    def _handle_history(self, msg):
+        if self.history is not None and msg[0] != self.nick:
+            self.history.add(msg[0], msg.source.nick, msg[1])
+
+    def _schedule_command(self, msg, channel, cmd, args):
+        if self._ratelimit is None:
+            self._dispatch_command(msg, channel, cmd, args)
+            return
+        source = msg.source
+        key = '%s@%s' % (source.ident, source.host) if source.complete else source.nick
+        queue = self._cmd_queue.get(key)
+        if (queue is None and len(self._writebuf) < OUTPUT_BACKLOG and
+                self._ratelimit.consume(key, cmd.cost)):
+            self._dispatch_command(msg, channel, cmd, args)
+            return
+        if queue is None:
+            queue = self._cmd_queue[key] = collections.deque()
+            self._cmd_queue_tmr.start()
+        if len(queue) < self.app.config['IRC_RATE_LIMIT_QUEUE']:
+            queue.append((msg, channel, cmd, args))
+        if key not in self._throttled:
+            self._throttled.add(key)
+            self.send('NOTICE %s :You are sending commands too fast; '
+                'further commands will be delayed or ignored.' % source.nick)
+
+    def _cmd_queue_cb(self, watcher, revents):
+        # Run at most one command per user and round, starting with the user
+        # who has been waiting the longest.
+        for key in self._cmd_queue.keys():
+            if len(self._writebuf) >= OUTPUT_BACKLOG:
+                break
+            queue = self._cmd_queue.get(key)
+            if queue is None:
+                continue # the connection was reset by a previous command
+            msg, channel, cmd, args = queue[0]
+            if not self._ratelimit.consume(key, cmd.cost):
+                continue
+            queue.popleft()
+            del self._cmd_queue[key]
+            if queue:
+                self._cmd_queue[key] = queue # move to the end
+            else:
+                self._throttled.discard(key)
+            self._dispatch_command(msg, channel, cmd, args)
+        if not self._cmd_queue:
+            self._cmd_queue_tmr.stop()
+
+    def _dispatch_command(self, msg, channel, cmd, args):
+        if cmd.cache_ttl and not self._has_access_checks(cmd):
+            # Nothing has to run before a cached response may be sent, so
+            # serve hits without setting up the application contexts
+            try:
+                parsed = cmd.parse(args)
+            except CommandAborted, e:
+                self._send_aborted(msg, e)
+                return
+            cache_key = cmd.get_cache_key(msg.source, channel, parsed)
+            ret = self._response_cache.get(cache_key, _MISSING)
+            if ret is not _MISSING:
+                self._log_command(msg, channel, cmd, args)
+                self._send_output(msg, ret)
+                return
+        base_url = self.app.config.get('BASE_URL')
+        with self.app.app_context():
+            with self.app.test_request_context(base_url=base_url):
+                self._run_command(msg, channel, cmd, args)
+
+    def _has_access_checks(self, cmd):
+        return bool(self._events.get(BEFORE_COMMAND) or
+                    cmd.module._events.get(BEFORE_COMMAND))
+
+    def _handle_patterns(self, msg):
+        if not self._patterns or (self.ignores and self.ignores.match(msg.source)):
+            return
+        for (module, func), match in self._patterns.match(msg[1]):
+            func(msg, match)
 
     def _run_command(self, msg, channel, cmd, args):
         try:
             self._trigger_event(BEFORE_COMMAND, msg, cmd)
             cmd.module._trigger_event(BEFORE_COMMAND, msg, cmd)
-            ret = cmd(msg.source, channel, args)
+            parsed = cmd.parse(args)
+            if cmd.cache_ttl:
+                # The before_command handlers above are access checks which
+                # also apply to cached responses
+                cache_key = cmd.get_cache_key(msg.source, channel, parsed)
+                ret = self._response_cache.get(cache_key, _MISSING)
+                if ret is _MISSING:
+                    ret = cmd(msg.source, channel, args, parsed)
+                    self._response_cache.set(cache_key, ret, cmd.cache_ttl)
+            else:
+                ret = cmd(msg.source, channel, args, parsed)
         except CommandAborted, e:
-            exc_reason = convert_formatting(to_unicode(e.message))
-            self.send_multi('NOTICE %s :%%s' % msg.source.nick, exc_reason.splitlines())
+            self._send_aborted(msg, e)
             return
         except werkzeug.exceptions.Forbidden:
             self.send('NOTICE %s :Access denied.' % msg.source.nick)
             return
         else:
-            log = '(%s) [%s]: %s %s' % (channel or '', msg.source.nick, cmd.name,
-                ' '.join(args))
-            cmd.module.logger.getChild('cmd').info(log.rstrip())
+            self._log_command(msg, channel, cmd, args)
+        self._send_output(msg, ret)
+
+    def _log_command(self, msg, channel, cmd, args):
+        log = '(%s) [%s]: %s %s' % (channel or '', msg.source.nick, cmd.name,
+            ' '.join(args))
+        cmd.module.logger.getChild('cmd').info(log.rstrip())
+
+    def _send_aborted(self, msg, exc):
+        exc_reason = convert_formatting(to_unicode(exc.message))
+        self.send_multi('NOTICE %s :%%s' % msg.source.nick, exc_reason.splitlines())
+
+    def _send_output(self, msg, ret):
         if not ret:
             return
         self.send_multi('NOTICE %s :%%s' % msg.source.nick, ret)
 
     def _parse_line(self, line):
-        self._log_io('in', line)
         msg = IRCMessage(line)
+        self.io_log.log('in', line, msg.cmd)
+        if self._workers:
+            self._forward_line(line, msg)
+        if msg.cmd in self._lazy_events:
+            for name in list(self._lazy_events[msg.cmd]):
+                self._activate_lazy_module(name)
         for handler in self._handlers.get(msg.cmd, []):
             handler(msg)
+        if self._worker_id is not None and self._route(msg) not in (None, self._worker_id):
+            return # only received to keep the connection state up to date
         for module in self.modules.itervalues():
             module._handle_cmd(msg)
+        if self._wants_batch(msg.cmd):
+            self._collect_burst(msg)
+
+    def _wants_batch(self, cmd):
+        return cmd in self._batch_handlers or any(cmd in module._batch_handlers
+            for module in self.modules.itervalues())
+
+    def _collect_burst(self, msg):
+        batch = self._batches.get(msg.tags.get('batch'))
+        if batch is not None:
+            # Delivered when the server ends the batch
+            batch.append(msg)
+            return
+        now = self.loop.now()
+        self._burst.append(msg)
+        if self._burst_started is None:
+            self._burst_started = now
+            self._burst_tmr.start()
+        elif (msg.cmd == 'QUIT' and msg.args and NETSPLIT_RE.match(msg[0]) and
+                now - self._burst_started < self.app.config['IRC_BURST_MAX_DELAY']):
+            # Keep collecting as long as the netsplit goes on
+            self._burst_tmr.stop()
+            self._burst_tmr.set(self.app.config['IRC_BURST_WINDOW'], 0)
+            self._burst_tmr.start()
+
+    def _burst_cb(self, watcher, revents):
+        self._flush_burst()
+
+    def _flush_burst(self):
+        self._burst_tmr.stop()
+        msgs = self._burst
+        self._burst = []
+        self._burst_started = None
+        self._deliver_batch(msgs)
+
+    def _deliver_batch(self, msgs):
+        by_cmd = collections.OrderedDict()
+        for msg in msgs:
+            by_cmd.setdefault(msg.cmd, []).append(msg)
+        for cmd, cmd_msgs in by_cmd.iteritems():
+            for handler in self._batch_handlers.get(cmd, []):
+                handler(cmd_msgs)
+            for module in self.modules.itervalues():
+                module._handle_batch(cmd, cmd_msgs)
 
     def _trigger_event(self, evt, *args):
         if evt not in BOT_EVENTS:
             raise ValueError('Unknown event name')
         for handler in self._events.get(evt, []):
             handler(*args)
-        if evt in COMMON_EVENTS:
+        if evt in WORKER_EVENTS:
+            for worker in self._workers:
+                self._send_worker(worker, ipc.FRAME_EVENT, evt)
+        if evt in COMMON_EVENTS and self._runs_global_tasks():
             for module in self.modules.itervalues():
                 module._trigger_event(evt, *args)
 
     def _connected(self):
         self._trigger_event(CONNECT)
+        # Servers without capability negotiation ignore this
+        self.send('CAP LS 302')
         if self.app.config['IRC_SERVER_PASS']:
             self.send('PASS :%s' % self.app.config['IRC_SERVER_PASS'])
         self.send('NICK %s' % self.app.config['IRC_NICK'])
@@ -307,72 +1376,205 @@ class Bot(object):
         self.loop.stop(pyev.EVBREAK_ALL)
 
     def _connect(self):
-        bind_host = self.app.config['IRC_SERVER_BIND']
-        host = self.app.config['IRC_SERVER_HOST']
-        port = self.app.config['IRC_SERVER_PORT']
+        server = self._current_server = self.servers.select(self.loop.now())
+        self._resolving = server
+        # getaddrinfo blocks, so it must not run in the loop thread
+        thread = threading.Thread(target=self._resolve, name='flask-irc-resolve',
+            args=(server, self.app.config['IRC_SERVER_BIND']))
+        thread.daemon = True
+        thread.start()
+
+    def _resolve(self, server, bind_host):
+        """Resolves the addresses to connect from and to in a separate thread"""
         # Resolve bind host (local)
         try:
             ai_local = socket.getaddrinfo(bind_host, 0, 0, 0, socket.SOL_TCP, socket.AI_PASSIVE)
         except Exception, e:
-            self.logger.error('Could not resolve local host: %s' % e)
+            self.call_soon_threadsafe(self._resolved, server, None,
+                'Could not resolve local host: %s' % e)
             return
         # Resolve connect host (remote)
         try:
-            ai_remote = socket.getaddrinfo(host, port, 0, 0, socket.SOL_TCP)
+            ai_remote = socket.getaddrinfo(server.host, server.port, 0, 0, socket.SOL_TCP)
         except Exception, e:
-            self.logger.error('Could not resolve remote host: %s' % e)
+            self.call_soon_threadsafe(self._resolved, server, None,
+                'Could not resolve remote host %s: %s' % (server.host, e))
             return
         # Get all local/remote combinations that make sense (same protocols)
         combos = itertools.product(ai_local, ai_remote)
-        combos = itertools.ifilter(
-            lambda c: all(c[0][i] == c[1][i] for i in xrange(3)),
-            combos)
-        s = None
-        for local, remote in combos:
+        addrs = [c for c in combos if all(c[0][i] == c[1][i] for i in xrange(3))]
+        self.call_soon_threadsafe(self._resolved, server, addrs, None)
+
+    def _resolved(self, server, addrs, error):
+        if server is not self._resolving:
+            return # the connection attempt has been cancelled
+        self._resolving = None
+        if error:
+            self.logger.error(error)
+            self._reconnect()
+            return
+        self._connect_addrs = addrs
+        self._connect_next()
+
+    def _connect_next(self):
+        """Starts connecting to the next address of the current server"""
+        while self._connect_addrs:
+            local, remote = self._connect_addrs.pop(0)
             af, socktype, proto = local[:3]
             # Create socket
             try:
                 s = socket.socket(af, socktype, proto)
             except socket.error, msg:
-                s = None
                 continue
             # Bind socket to local address
             try:
                 s.bind(local[4])
             except socket.error, msg:
                 s.close()
-                s = None
                 continue
-            # Connect socket to remote address
-            try:
-                s.connect(remote[4])
-            except socket.error, msg:
+            # Connect socket to remote address; _connect_cb is called once
+            # the connection is established or has failed
+            s.setblocking(0)
+            err = s.connect_ex(remote[4])
+            if err and err != errno.EINPROGRESS and err not in NONBLOCKING:
                 s.close()
-                s = None
                 continue
-            self.logger.info('Connected to %s:%d' % remote[4])
-        if not s:
-            self.logger.error('Could not connect')
-            self._reconnect()
+            self._connect_sock = s
+            self._connect_remote = remote[4]
+            self._connect_started = time.time()
+            self._connect_watcher = pyev.Io(s, pyev.EV_WRITE, self.loop, self._connect_cb)
+            self._connect_watcher.start()
+            self._connect_tmr.start()
+            return
+        self.logger.error('Could not connect to %s' % self._current_server.address)
+        self._reconnect()
+
+    def _connect_cb(self, watcher, revents):
+        s = self._connect_sock
+        remote = self._connect_remote
+        self._stop_connecting()
+        err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.logger.debug('Could not connect to %s:%d: %s' % (remote[0], remote[1],
+                os.strerror(err)))
+            s.close()
+            self._connect_next()
             return
-        s.setblocking(0)
+        self.servers.record_lag(self._current_server, time.time() - self._connect_started)
+        self.logger.info('Connected to %s:%d' % remote[:2])
+        self._start_connection(s)
+
+    def _connect_timeout_cb(self, watcher, revents):
+        s = self._connect_sock
+        remote = self._connect_remote
+        self._stop_connecting()
+        s.close()
+        self.logger.debug('Connecting to %s:%d timed out' % remote[:2])
+        self._connect_next()
+
+    def _stop_connecting(self):
+        self._connect_tmr.stop()
+        if self._connect_watcher is not None:
+            self._connect_watcher.stop()
+            self._connect_watcher = None
+        self._connect_sock = None
+
+    def _start_connection(self, s):
+        server = self._current_server
+        host = server.host
+        use_ssl = server.ssl if server.ssl is not None else self.app.config['IRC_SERVER_SSL']
+        if use_ssl:
+            try:
+                s = self._wrap_ssl(s, host)
+            except (ssl.SSLError, socket.error), e:
+                self.logger.error('Could not set up TLS: %s' % e)
+                s.close()
+                self._reconnect()
+                return
+            # The handshake is performed by _io_cb once the socket is ready
+            self._handshaking = True
+            events = pyev.EV_READ | pyev.EV_WRITE
+        else:
+            events = pyev.EV_READ
         self.sock = s
-        self.watcher = pyev.Io(s, pyev.EV_READ, self.loop, self._io_cb)
+        self.watcher = pyev.Io(s, events, self.loop, self._io_cb)
         self.watcher.start()
+        # Give up if the handshake and registration take too long
+        self._start_ping_timeout()
+        if self._keepalive_tmr is not None:
+            self._keepalive_tmr.start()
+        if not self._handshaking:
+            self._connected()
+
+    def _get_ssl_context(self):
+        if self._ssl_context is None:
+            config = self.app.config
+            context = ssl.create_default_context(cafile=config['IRC_SSL_CA_CERTS'])
+            if not config['IRC_SSL_VERIFY']:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            if config['IRC_SSL_CERTFILE']:
+                context.load_cert_chain(config['IRC_SSL_CERTFILE'], config['IRC_SSL_KEYFILE'])
+            self._ssl_context = context
+        return self._ssl_context
+
+    def _wrap_ssl(self, sock, host):
+        return self._get_ssl_context().wrap_socket(sock, server_hostname=host,
+            do_handshake_on_connect=False)
+
+    def _ssl_handshake(self):
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self._set_io_events(pyev.EV_READ)
+            return
+        except ssl.SSLWantWriteError:
+            self._set_io_events(pyev.EV_WRITE)
+            return
+        except (ssl.SSLError, socket.error), e:
+            self.logger.warn('TLS handshake failed: %s' % e)
+            self._close()
+            self._reconnect()
+            return
+        self._handshaking = False
+        self.logger.info('TLS connection established (%s)' % self.sock.version())
+        self._set_io_events(pyev.EV_READ | (pyev.EV_WRITE if self._writebuf else 0))
         self._connected()
 
+    def _set_io_events(self, events):
+        self.watcher.stop()
+        self.watcher.set(self.watcher.fd, events)
+        self.watcher.start()
+
     def _io_cb(self, watcher, revents):
+        if self._handshaking:
+            self._ssl_handshake()
+            return
+        if self._ssl_blocked:
+            # Retry whatever was waiting for this event with the normal mask
+            self._ssl_blocked = False
+            self._set_io_events(pyev.EV_READ | (pyev.EV_WRITE if self._writebuf else 0))
+            revents = pyev.EV_READ | pyev.EV_WRITE
         if revents & pyev.EV_READ:
             self._io_read()
-        if revents & pyev.EV_WRITE:
+        if revents & pyev.EV_WRITE and self._writebuf and not self._ssl_blocked:
             self._io_write()
-        if self._stop_loop and not (self.watcher.events & pyev.EV_WRITE):
+        if self._stop_loop and not self._writebuf:
             self.loop.stop()
             self._stop_loop = False
 
     def _io_read(self):
         try:
             buf = self.sock.recv(1024)
+            if buf and isinstance(self.sock, ssl.SSLSocket):
+                # Decrypted data buffered by OpenSSL does not trigger EV_READ
+                while self.sock.pending():
+                    buf += self.sock.recv(self.sock.pending())
+        except ssl.SSLWantReadError:
+            pass
+        except ssl.SSLWantWriteError:
+            # Renegotiation needs to write before more data can be read
+            self._ssl_wait(pyev.EV_WRITE)
         except socket.error, e:
             if e.args[0] not in NONBLOCKING:
                 self.logger.warn('Error reading from socket: %s' % e)
@@ -394,6 +1596,11 @@ class Bot(object):
     def _io_write(self):
         try:
             num = self.sock.send(self._writebuf)
+        except ssl.SSLWantWriteError:
+            pass
+        except ssl.SSLWantReadError:
+            # Renegotiation needs to read before more data can be written
+            self._ssl_wait(pyev.EV_READ)
         except socket.error, e:
             if e.args[0] not in NONBLOCKING:
                 self.logger.warn('Error writing to socket: %s' % e)
@@ -401,26 +1608,76 @@ class Bot(object):
                 self._reconnect()
         else:
             self._writebuf = self._writebuf[num:]
+            self._written_bytes += num
+            while self._deliveries and self._deliveries[0][0] <= self._written_bytes:
+                self._deliveries.popleft()[1].set_result(True)
             if not self._writebuf:
                 self.watcher.stop()
                 self.watcher.set(self.watcher.fd, self.watcher.events & ~pyev.EV_WRITE)
                 self.watcher.start()
 
+    def _ssl_wait(self, events):
+        self._ssl_blocked = True
+        self._set_io_events(events)
+
     def _close(self):
+        if self._connect_sock is not None:
+            s = self._connect_sock
+            self._stop_connecting()
+            s.close()
+        self._resolving = None
+        self._connect_addrs = []
         if self.sock is not None:
+            if isinstance(self.sock, ssl.SSLSocket) and not self._handshaking:
+                # Send close_notify so the server sees a clean shutdown. The
+                # socket is non-blocking, so the reply is not waited for.
+                try:
+                    self.sock.unwrap()
+                except (ssl.SSLError, socket.error):
+                    pass
             self.sock.close()
             self.sock = None
         if self.watcher is not None:
             self.watcher.stop()
             self.watcher = None
+        self._handshaking = False
+        self._ssl_blocked = False
+        self._stop_keepalive()
         self._readbuf = ''
         self._writebuf = ''
+        self._written_bytes = self._queued_bytes
+        while self._deliveries:
+            self._deliveries.popleft()[1].set_exception(socket.error('Connection closed'))
+        self._reset_connection()
+
+    def _reset_connection(self):
+        self._cmd_queue.clear()
+        self._throttled.clear()
+        # Deliver what has been received before the connection was lost
+        for msgs in self._batches.itervalues():
+            self._burst += msgs
+        self._batches.clear()
+        self._flush_burst()
+        self._available_caps.clear()
+        self.caps = set()
+        if self._ratelimit is not None:
+            self._cmd_queue_tmr.stop()
         self._trigger_event(DISCONNECT)
         self.nick = None
         self.server = None
+        self.isupport = {}
+        self.channels = set()
+        self._userhost = None
         self.ready = False
 
     def _reconnect(self):
+        if self._worker_id is not None:
+            # Lost the connection to the gateway
+            self.loop.stop(pyev.EVBREAK_ALL)
+            return
+        if self._current_server is not None:
+            # Prefer another server for a while
+            self.servers.failure(self._current_server, self.loop.now())
         self._reconnect_tmr.reset()
         delay = self.app.config['IRC_RECONNECT_DELAY']
         self.logger.debug('Reconnecting in %us' % delay)
@@ -431,24 +1688,99 @@ class Bot(object):
         self._connect()
 
 
+def _pack_targets(targets, budget, max_targets):
+    """Groups targets so each group fits in `budget` bytes when comma-joined"""
+    group = []
+    size = 0
+    for target in targets:
+        length = len(target) + bool(group) # including the comma
+        if group and (size + length > budget or len(group) == max_targets):
+            yield group
+            group = []
+            length = len(target)
+            size = 0
+        group.append(target)
+        size += length
+    if group:
+        yield group
+
+
+def _worker_index(key, count):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return (zlib.crc32(key) & 0xffffffff) % count
+
+
+def _load_fresh_module(pymod):
+    """Executes a module's current code in a new module object"""
+    name = pymod.__name__
+    code = pkgutil.get_loader(name).get_code(name)
+    new_pymod = imp.new_module(name)
+    new_pymod.__file__ = pymod.__file__
+    new_pymod.__package__ = pymod.__package__
+    if hasattr(pymod, '__path__'):
+        new_pymod.__path__ = pymod.__path__
+    exec code in new_pymod.__dict__
+    return new_pymod
+
+def _set_module(pymod):
+    """Makes a module object the one returned by imports"""
+    name = pymod.__name__
+    sys.modules[name] = pymod
+    parent, _, child = name.rpartition('.')
+    if parent in sys.modules:
+        setattr(sys.modules[parent], child, pymod)
+
+
 class _ModuleState(object):
+    def __init__(self, items=None):
+        # Names of attributes changed since the state was last saved
+        object.__setattr__(self, '_dirty', set())
+        if items:
+            self.__dict__.update(items)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        self._dirty.add(name)
+
+    def __delattr__(self, name):
+        object.__delattr__(self, name)
+        self._dirty.add(name)
+
+    def touch(self, *names):
+        """Marks attributes as changed after modifying them in-place"""
+        self._dirty.update(names)
+
+    def _pop_dirty(self):
+        dirty = self._dirty
+        object.__setattr__(self, '_dirty', set())
+        return dirty
+
+    def _items(self):
+        return dict((k, v) for k, v in self.__dict__.iteritems() if k != '_dirty')
+
     def __repr__(self):
-        return '<ModuleState(%r)>' % self.__dict__
+        return '<ModuleState(%r)>' % self._items()
 
 
 class BotModule(object):
-    def __init__(self, name, import_name=None, logger_name=None):
+    def __init__(self, name, import_name=None, logger_name=None, persistent=False):
         self._import_name = import_name
         self.name = name
         self.logger_name = logger_name
+        self.persistent = persistent
+        self._state_store = None
         self._reload_module = reload
         self.g = _ModuleState()
         self.bot = None
         self._handlers = {}
+        self._batch_handlers = {}
         self._events = {}
         self._commands = {}
+        self._matchers = []
         self._timers = []
         self._timer_factories = []
+        self._reloading = False
         if self.name not in module_list:
             # Register if the module is new (i.e. not just reloaded)
             module_list[self.name] = self
@@ -456,8 +1788,16 @@ class BotModule(object):
     def init_bot(self, bot, _state=None):
         self.bot = bot
         self._init_logger()
+        if self.persistent and self._state_store is None:
+            self._state_store = self.bot._create_state_store(self)
+        if _state is None and self._state_store is not None:
+            items = self._state_store.load()
+            if items:
+                _state = self.g = _ModuleState(items)
         self.bot._register_module(self)
         self._trigger_event(INIT, _state)
+        if not self.bot._runs_global_tasks():
+            return
         if self.bot.ready:
             self._trigger_event(READY)
         for func in self._timer_factories:
@@ -469,9 +1809,17 @@ class BotModule(object):
         else:
             self.logger = self.bot.logger.getChild(self.logger_name)
 
-    def reload(self):
-        """Reloads the module (if it's reloadable)"""
-        if not self._import_name:
+    def reload(self, callback=None):
+        """Reloads the module (if it's reloadable)
+
+        The module's code is loaded into a new Python module in a background
+        thread while the old module keeps running. Afterwards the old module
+        is replaced with the new one in a single event loop iteration. If the
+        new module fails to initialize, the old one is restored.
+
+        Returns False if the module cannot be reloaded. Otherwise the optional
+        callback is called with a success flag once reloading has finished."""
+        if not self._import_name or self._reloading:
             return False
         pymod = importlib.import_module(self._import_name)
         mod_var = None
@@ -486,27 +1834,88 @@ class BotModule(object):
                 break
         if not mod_var:
             return False
-        try:
-            pymod = reload(pymod)
-        except Exception, e:
-            self.logger.error('Could not reload module: %s' % e)
-            return False
-        self.bot._unregister_module(self)
-        self._trigger_event(RELOAD)
-        mod = getattr(pymod, mod_var)
-        module_list[mod.name] = mod # re-register new module
-        mod.init_bot(self.bot, _state=self.g)
+        self._reloading = True
+        thread = threading.Thread(target=self._load_new_module, args=(pymod, mod_var, callback),
+            name='flask-irc-reload')
+        thread.daemon = True
+        thread.start()
         return True
 
+    def _load_new_module(self, pymod, mod_var, callback):
+        # Runs in a separate thread. The module is executed in a fresh module
+        # object so the running module's globals are not touched.
+        try:
+            new_pymod = _load_fresh_module(pymod)
+            mod = getattr(new_pymod, mod_var)
+        except Exception:
+            self.logger.exception('Could not reload module')
+            new_pymod = mod = None
+        self.bot.call_soon_threadsafe(self._swap_module, pymod, new_pymod, mod, callback)
+
+    def _swap_module(self, old_pymod, pymod, mod, callback):
+        if not self._reloading or self.bot.modules.get(self.name) is not self:
+            # Unloaded while the new code was being loaded
+            if callback is not None:
+                callback(False)
+            return
+        self._reloading = False
+        success = mod is not None
+        if success:
+            self.bot._unregister_module(self)
+            self._trigger_event(RELOAD)
+            module_list[mod.name] = mod # re-register new module
+            mod._state_store = self._state_store
+            _set_module(pymod)
+            try:
+                mod.init_bot(self.bot, _state=self.g)
+            except Exception:
+                self.logger.exception('Could not initialize reloaded module')
+                if mod.name in self.bot.modules:
+                    self.bot._unregister_module(mod)
+                # Roll back to the old module
+                module_list[self.name] = self
+                _set_module(old_pymod)
+                self._timers = []
+                self.init_bot(self.bot, _state=self.g)
+                success = False
+        if callback is not None:
+            callback(success)
+
     def unload(self):
-        """Unloads the module"""
+        """Unloads the module, cancelling a pending reload"""
+        self._reloading = False
         self.bot._unregister_module(self)
         self._trigger_event(UNLOAD)
+        self.save_state()
+
+    def save_state(self):
+        """Saves the changed parts of the module state if it is persistent.
 
-    def on(self, cmd):
-        """A decorator to register a handler for an IRC command"""
+        Attributes of `g` are tracked automatically when they are assigned;
+        use `g.touch(name)` after modifying a mutable value in-place."""
+        if self._state_store is not None and isinstance(self.g, _ModuleState):
+            self._state_store.save(self.g)
+
+    def on(self, cmd, batch=False):
+        """A decorator to register a handler for an IRC command
+
+        If the batch flag is set, the handler is called with a list of
+        messages. Messages arriving in bursts, e.g. QUITs during a netsplit,
+        are collected and delivered together."""
+        handlers = self._batch_handlers if batch else self._handlers
         def decorator(f):
-            self._handlers.setdefault(cmd, []).append(f)
+            handlers.setdefault(cmd, []).append(f)
+            return f
+        return decorator
+
+    def match(self, pattern, flags=0):
+        """A decorator to register a handler for messages matching a regex
+
+        The handler is called with the message and the match object. The
+        patterns of all modules are combined so each PRIVMSG is only scanned
+        once, no matter how many patterns are registered."""
+        def decorator(f):
+            self._matchers.append((pattern, flags, f))
             return f
         return decorator
 
@@ -538,7 +1947,7 @@ class BotModule(object):
                 tmr.start()
                 self._timers.append(tmr)
             self._timer_factories.append(_start_timer)
-            if self.bot:
+            if self.bot and self.bot._runs_global_tasks():
                 _start_timer()
             return f
         return decorator
@@ -551,23 +1960,43 @@ class BotModule(object):
         production environment."""
         for cmd in self._commands.itervalues():
             cmd._func = decorator(cmd._func)
+            cmd._decorated = True
 
-    def command(self, name, greedy=False):
+    def command(self, name, greedy=False, cost=1, cache_ttl=None, cache_key=None):
         """A decorator to register a command
 
         If the greedy flag is set the last positional argument will include
-        all following unused arguments."""
+        all following unused arguments. The cost is the number of tokens taken
+        from the user's rate limit bucket when running the command.
+
+        If cache_ttl is set, the output of the command is cached for that many
+        seconds based on its arguments. Only use it for commands whose output
+        does not depend on who runs them. The cache_key function is called
+        with the source, channel and argument dict and its return value is
+        added to the cache key, e.g. to cache the output per channel.
+        Unless there are before_command handlers, cached output is sent
+        without entering the application context, so cache_key must not
+        rely on it."""
         def decorator(f):
             if name in self._commands:
                 raise ValueError('A command named %s already exists' % name)
-            self._commands[name] = _BotCommand(self, name, f, greedy)
+            self._commands[name] = _BotCommand(self, name, f, greedy, cost, cache_ttl,
+                cache_key)
             return f
         return decorator
 
+    def invalidate_cache(self, command=None):
+        """Removes cached responses of the module's commands"""
+        self.bot.invalidate_cache(self, command)
+
     def _handle_cmd(self, msg):
         for handler in self._handlers.get(msg.cmd, []):
             handler(msg)
 
+    def _handle_batch(self, cmd, msgs):
+        for handler in self._batch_handlers.get(cmd, []):
+            handler(msgs)
+
     def _trigger_event(self, evt, *args):
         if evt not in MOD_EVENTS:
             raise ValueError('Unknown event name')
@@ -584,10 +2013,15 @@ class BotModule(object):
 class CommandAborted(Exception): pass
 
 class _BotCommand(object):
-    def __init__(self, module, name, func, greedy):
+    def __init__(self, module, name, func, greedy, cost=1, cache_ttl=None,
+            cache_key=None):
         self.module = module
         self.name = name
+        self.cost = cost
+        self.cache_ttl = cache_ttl
+        self._cache_key = cache_key
         self._func = func
+        self._decorated = False
         self._greedy = greedy
         self._greedy_arg = None
         self.shorthelp = None
@@ -649,7 +2083,8 @@ class _BotCommand(object):
             ret = list(output) # probably a generator
         return map(convert_formatting, map(to_unicode, ret))
 
-    def __call__(self, source, channel, args):
+    def parse(self, args):
+        """Parses the arguments into positional and keyword arguments"""
         self._parser.reset()
         try:
             if self._varargs or self._greedy:
@@ -665,6 +2100,23 @@ class _BotCommand(object):
             greedy_value = ' '.join([kwargs[self._greedy_arg]] + remaining)
             kwargs[self._greedy_arg] = greedy_value
             remaining = []
+        return remaining, kwargs
+
+    def get_cache_key(self, source, channel, parsed):
+        remaining, kwargs = parsed
+        key = (self.module.name, self.name, tuple(remaining), tuple(sorted(kwargs.items())))
+        if self._decorated:
+            # Decorators usually check access so never share cached output
+            # between different users
+            key += (str(source),)
+        if self._cache_key is not None:
+            key += (self._cache_key(source, channel, kwargs),)
+        return key
+
+    def __call__(self, source, channel, args, parsed=None):
+        if parsed is None:
+            parsed = self.parse(args)
+        remaining, kwargs = parsed
         return self._format_output(self._func(source, channel, *remaining, **kwargs))
 
     def __hash__(self):
@@ -680,6 +2132,21 @@ class _BotCommand(object):
         return "<BotCommand('%s', '%s', %r)>" % (self.module, self.name, self._func)
 
 
+class _Worker(object):
+    """A worker process as seen by the gateway"""
+    def __init__(self, index, pid, sock):
+        self.index = index
+        self.pid = pid
+        self.sock = sock
+        self.watcher = None
+        self.reader = ipc.FrameReader()
+        self.writebuf = ''
+        self.dropped = 0
+
+    def __repr__(self):
+        return '<Worker(%d, pid=%d)>' % (self.index, self.pid)
+
+
 class _ParserExit(Exception): pass
 
 class _BotArgumentParser(argparse.ArgumentParser):
@@ -0,0 +1,85 @@
+"""Passing a live IRC connection to another process"""
+
+import base64
+import json
+import os
+import select
+import socket
+import struct
+import time
+
+from _multiprocessing import sendfd, recvfd
+
+# Set in the environment of the new process; contains the handoff socket path
+HANDOFF_ENV = 'FLASK_IRC_HANDOFF'
+_HEADER = struct.Struct('!I')
+_ACK = 'OK'
+# Connection state entries containing raw bytes
+_BUFFERS = ('readbuf', 'writebuf')
+
+
+def listen(path):
+    """Creates the unix socket the new process connects to"""
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(1)
+    return sock
+
+def send_connection(conn, sock, state, timeout=10):
+    """Sends the connection state and the socket's fd to the new process.
+
+    Returns True if the new process confirmed that it took over the socket.
+    """
+    state = dict(state, family=sock.family, type=sock.type)
+    for key in _BUFFERS:
+        state[key] = base64.b64encode(state[key])
+    data = json.dumps(state)
+    conn.settimeout(timeout)
+    conn.sendall(_HEADER.pack(len(data)) + data)
+    sendfd(conn.fileno(), sock.fileno())
+    return _recv_exactly(conn, len(_ACK)) == _ACK
+
+def receive_connection(path, timeout=10):
+    """Receives the connection state and socket from the old process"""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            conn.connect(path)
+        except socket.error:
+            # The old process may not be listening yet
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+        else:
+            break
+    try:
+        length, = _HEADER.unpack(_recv_exactly(conn, _HEADER.size))
+        state = json.loads(_recv_exactly(conn, length))
+        fd = _recv_fd(conn)
+        sock = socket.fromfd(fd, state.pop('family'), state.pop('type'))
+        os.close(fd)
+        for key in _BUFFERS:
+            state[key] = base64.b64decode(state[key])
+        conn.sendall(_ACK)
+    finally:
+        conn.close()
+    return sock, state
+
+def _recv_fd(conn):
+    # A socket with a timeout is non-blocking, so wait until the fd arrived
+    if not select.select([conn], [], [], conn.gettimeout())[0]:
+        raise socket.timeout('Timed out waiting for the connection')
+    return recvfd(conn.fileno())
+
+def _recv_exactly(conn, size):
+    data = ''
+    while len(data) < size:
+        buf = conn.recv(size - len(data))
+        if not buf:
+            raise socket.error('Connection closed during handoff')
+        data += buf
+    return data
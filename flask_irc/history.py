@@ -0,0 +1,431 @@
+"""A compact store for the message history of channels"""
+
+import array
+import bisect
+import collections
+import mmap
+import os
+import re
+import struct
+import time
+
+HistoryEntry = collections.namedtuple('HistoryEntry', 'time channel nick text')
+
+_word_re = re.compile(r'\w+', re.UNICODE)
+_non_ascii_re = re.compile(r'[^\x00-\x7f]')
+# Spilled records: timestamp, nick length, text length, nick, text and the
+# length of all this so the files can be read backwards
+_RECORD_HEADER = struct.Struct('!dBH')
+_RECORD_TRAILER = struct.Struct('!I')
+
+
+def _words(text):
+    return set(_word_re.findall(text.lower()))
+
+
+class _Postings(object):
+    """An ascending list of message numbers.
+
+    Numbers are only appended and removed from the start, so an array with
+    a start offset is enough; the array is compacted once half of it is
+    unused.
+    """
+    __slots__ = ('seqs', 'start')
+
+    def __init__(self):
+        self.seqs = array.array('L')
+        self.start = 0
+
+    def append(self, seq):
+        self.seqs.append(seq)
+
+    def popleft(self):
+        self.start += 1
+        if self.start * 2 >= len(self.seqs):
+            del self.seqs[:self.start]
+            self.start = 0
+
+    def newest(self):
+        """Iterates over the numbers, starting with the highest one"""
+        for i in xrange(len(self.seqs) - 1, self.start - 1, -1):
+            yield self.seqs[i]
+
+    def __contains__(self, seq):
+        i = bisect.bisect_left(self.seqs, seq, self.start)
+        return i < len(self.seqs) and self.seqs[i] == seq
+
+    def __len__(self):
+        return len(self.seqs) - self.start
+
+
+class _ChannelHistory(object):
+    """The most recent messages of a channel in a ring buffer.
+
+    Every message gets an increasing number; it is stored in the slot
+    `number % size`. The slots are allocated as messages arrive, so quiet
+    channels stay small. The texts are appended to a single byte buffer;
+    since the oldest message is evicted first, evicted texts are always at
+    the start of the buffer, which is compacted once half of it is unused.
+    The indexes map nick ids and words to the numbers of the messages that
+    are still in the buffer.
+    """
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.next_seq = 0
+        self.times = array.array('d')
+        self.nicks = array.array('l')
+        self.offsets = array.array('L') # position of the text in all texts ever added
+        self.lengths = array.array('I')
+        self.data = bytearray() # utf-8 encoded texts
+        self.base = 0 # position of the first byte of `data`
+        self.unused = 0 # bytes of evicted texts at the start of `data`
+        self.by_nick = {}
+        self.by_word = {}
+
+    def add(self, timestamp, nick_id, text):
+        """Adds a message and returns the evicted one, if any"""
+        seq = self.next_seq
+        self.next_seq += 1
+        slot = seq % self.size
+        evicted = None
+        if seq < self.size:
+            self.times.append(timestamp)
+            self.nicks.append(nick_id)
+            self.offsets.append(0)
+            self.lengths.append(0)
+        else:
+            evicted = self._evict(slot)
+        data = text.encode('utf-8')
+        self.times[slot] = timestamp
+        self.nicks[slot] = nick_id
+        self.offsets[slot] = self.base + len(self.data)
+        self.lengths[slot] = len(data)
+        self.data += data
+        self.by_nick.setdefault(nick_id, _Postings()).append(seq)
+        for word in _words(text):
+            self.by_word.setdefault(word, _Postings()).append(seq)
+        return evicted
+
+    def _evict(self, slot):
+        nick_id = self.nicks[slot]
+        data = self._text(slot)
+        self.unused += len(data)
+        if self.unused * 2 >= len(self.data):
+            del self.data[:self.unused]
+            self.base += self.unused
+            self.unused = 0
+        # The evicted message is the oldest one, i.e. the first in its postings
+        self._remove_posting(self.by_nick, nick_id)
+        for word in _words(data.decode('utf-8')):
+            self._remove_posting(self.by_word, word)
+        return self.times[slot], nick_id, data
+
+    def _text(self, slot):
+        pos = self.offsets[slot] - self.base
+        return str(self.data[pos:pos + self.lengths[slot]])
+
+    def _remove_posting(self, index, key):
+        postings = index[key]
+        postings.popleft()
+        if not postings:
+            del index[key]
+
+    def get(self, seq):
+        slot = seq % self.size
+        return self.times[slot], self.nicks[slot], self._text(slot)
+
+    def newest(self):
+        first = max(0, self.next_seq - self.size)
+        return xrange(self.next_seq - 1, first - 1, -1)
+
+    def __len__(self):
+        return min(self.next_seq, self.size)
+
+
+class _Segments(object):
+    """Append-only files containing the messages evicted from a channel.
+
+    A new file is started whenever the current one exceeds `segment_size`
+    and only the newest `max_segments` files are kept. Searching maps the
+    files into memory so reading them does not copy the whole file.
+    """
+    def __init__(self, directory, channel, segment_size, max_segments):
+        self.directory = directory
+        self.prefix = '%s.' % channel.encode('utf-8').encode('hex')
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.numbers = sorted(int(name[len(self.prefix):-4]) for name in os.listdir(directory)
+                              if name.startswith(self.prefix) and name.endswith('.seg'))
+        self._file = None
+
+    def _path(self, number):
+        return os.path.join(self.directory, '%s%d.seg' % (self.prefix, number))
+
+    def append(self, timestamp, nick, data):
+        nick = nick.encode('utf-8')[:255]
+        data = data[:0xffff]
+        if self._file is None or self._file.tell() >= self.segment_size:
+            self._next_segment()
+        length = _RECORD_HEADER.size + len(nick) + len(data)
+        self._file.write(_RECORD_HEADER.pack(timestamp, len(nick), len(data)) + nick + data +
+                         _RECORD_TRAILER.pack(length))
+
+    def _next_segment(self):
+        if self._file is not None:
+            self._file.close()
+        number = self.numbers[-1] + 1 if self.numbers else 0
+        self.numbers.append(number)
+        while len(self.numbers) > self.max_segments:
+            os.unlink(self._path(self.numbers.pop(0)))
+        self._file = open(self._path(number), 'ab')
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def newest(self):
+        """Iterates over `(timestamp, nick, data)` tuples, newest first"""
+        self.flush()
+        for number in reversed(self.numbers):
+            for record in self._read_backwards(self._path(number)):
+                yield record
+
+    def _read_backwards(self, path):
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return
+            buf = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                for start, end in self._records(buf, size):
+                    timestamp, nick_len, data_len = _RECORD_HEADER.unpack_from(buf, start)
+                    pos = start + _RECORD_HEADER.size
+                    yield timestamp, buf[pos:pos + nick_len], buf[pos + nick_len:end]
+            finally:
+                buf.close()
+
+    def _records(self, buf, size):
+        """Iterates over the `(start, end)` offsets of the records, last one first"""
+        header_size = _RECORD_HEADER.size
+        trailer_size = _RECORD_TRAILER.size
+        end = size - trailer_size
+        while end >= header_size:
+            length, = _RECORD_TRAILER.unpack_from(buf, end)
+            start = end - length
+            if length < header_size or start < 0 or _record_length(buf, start) != length:
+                break
+            yield start, end
+            end = start - trailer_size
+        else:
+            return
+        if end == size - trailer_size:
+            # The last record is incomplete, e.g. after a crash; find the
+            # complete ones from the start
+            offsets = array.array('L')
+            pos = 0
+            while pos + header_size <= size:
+                length = _record_length(buf, pos)
+                if pos + length + trailer_size > size:
+                    break
+                offsets.append(pos)
+                pos += length + trailer_size
+            for start in reversed(offsets):
+                yield start, start + _record_length(buf, start)
+
+
+def _record_length(buf, start):
+    timestamp, nick_len, data_len = _RECORD_HEADER.unpack_from(buf, start)
+    return _RECORD_HEADER.size + nick_len + data_len
+
+
+class HistoryStore(object):
+    """Stores the last `size` messages of every channel.
+
+    Nicks are interned, i.e. stored as integer ids, and texts as utf-8 in
+    per-channel ring buffers. Indexes by nick and by word are
+    updated whenever a message is added or evicted, so looking up the last
+    messages of a user or the messages containing some words does not
+    scan the whole history.
+
+    If `spill_dir` is set, evicted messages are appended to segment files
+    in that directory and are included in searches, which is slower since
+    the files are scanned.
+
+    >>> store = HistoryStore(size=3)
+    >>> store.add('#chan', 'alice', u'Hello world', 1)
+    >>> store.add('#chan', 'bob', u'hello alice', 2)
+    >>> store.add('#Chan', 'Alice', u'Bye', 3)
+    >>> store.last('#chan', 'ALICE').text
+    u'Bye'
+    >>> [entry.nick for entry in store.search('#chan', 'hello')]
+    ['bob', 'alice']
+    >>> store.add('#chan', 'carol', u'Hello again', 4)
+    >>> [entry.nick for entry in store.search('#chan', 'hello')]
+    ['carol', 'bob']
+    >>> [entry.text for entry in store.search('#chan', 'hello', nick='bob')]
+    [u'hello alice']
+    >>> store.search('#chan', 'world')
+    []
+    """
+    def __init__(self, size=1000, spill_dir=None, segment_size=16 * 1024 * 1024,
+                 max_segments=8):
+        self.size = size
+        self.spill_dir = spill_dir
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self._channels = {}
+        self._segments = {}
+        self._nick_ids = {} # lowercase nick -> id
+        self._nicks = [] # id -> nick
+        self._nick_refs = array.array('l') # id -> number of stored messages
+        self._free_ids = []
+        if spill_dir and not os.path.isdir(spill_dir):
+            os.makedirs(spill_dir)
+
+    def _intern(self, nick):
+        key = nick.lower()
+        nick_id = self._nick_ids.get(key)
+        if nick_id is None:
+            if self._free_ids:
+                nick_id = self._free_ids.pop()
+                self._nicks[nick_id] = nick
+                self._nick_refs[nick_id] = 0
+            else:
+                nick_id = len(self._nicks)
+                self._nicks.append(nick)
+                self._nick_refs.append(0)
+            self._nick_ids[key] = nick_id
+        self._nick_refs[nick_id] += 1
+        return nick_id
+
+    def _release(self, nick_id):
+        self._nick_refs[nick_id] -= 1
+        if not self._nick_refs[nick_id]:
+            del self._nick_ids[self._nicks[nick_id].lower()]
+            self._nicks[nick_id] = None
+            self._free_ids.append(nick_id)
+
+    def add(self, channel, nick, text, timestamp=None):
+        """Adds a message to the history of a channel"""
+        if timestamp is None:
+            timestamp = time.time()
+        channel = channel.lower()
+        history = self._channels.get(channel)
+        if history is None:
+            history = self._channels[channel] = _ChannelHistory(channel, self.size)
+        evicted = history.add(timestamp, self._intern(nick), text)
+        if evicted is not None:
+            old_timestamp, nick_id, data = evicted
+            if self.spill_dir:
+                self._get_segments(channel).append(old_timestamp, self._nicks[nick_id], data)
+            self._release(nick_id)
+
+    def _get_segments(self, channel):
+        segments = self._segments.get(channel)
+        if segments is None:
+            segments = self._segments[channel] = _Segments(self.spill_dir, channel,
+                self.segment_size, self.max_segments)
+        return segments
+
+    def last(self, channel, nick=None):
+        """Returns the last message in a channel, optionally by a given nick"""
+        entries = self.search(channel, nick=nick, limit=1)
+        return entries[0] if entries else None
+
+    def search(self, channel, words=(), nick=None, limit=10, spilled=True):
+        """Returns the newest messages containing all given words.
+
+        `words` may be a string or a list of words; only whole words match.
+        Messages may also be restricted to a nick. Messages in spill files
+        are only searched if there are not enough matches in memory and the
+        `spilled` flag is set.
+        """
+        if isinstance(words, basestring):
+            words = _words(words)
+        else:
+            words = set(word.lower() for word in words)
+        channel = channel.lower()
+        entries = []
+        history = self._channels.get(channel)
+        if history is not None:
+            entries = self._search_memory(history, words, nick, limit)
+        if len(entries) < limit and spilled and self.spill_dir:
+            entries += self._search_spilled(channel, words, nick, limit - len(entries))
+        return entries
+
+    def _search_memory(self, history, words, nick, limit):
+        postings = []
+        if nick is not None:
+            nick_id = self._nick_ids.get(nick.lower())
+            postings.append(history.by_nick.get(nick_id))
+        for word in words:
+            postings.append(history.by_word.get(word))
+        if None in postings:
+            return []
+        if postings:
+            # Walk the shortest list and check the others
+            postings.sort(key=len)
+            candidates = postings[0].newest()
+            others = postings[1:]
+        else:
+            candidates = history.newest()
+            others = []
+        entries = []
+        for seq in candidates:
+            if all(seq in other for other in others):
+                timestamp, nick_id, data = history.get(seq)
+                entries.append(HistoryEntry(timestamp, history.name, self._nicks[nick_id],
+                    data.decode('utf-8')))
+                if len(entries) >= limit:
+                    break
+        return entries
+
+    def _search_spilled(self, channel, words, nick, limit):
+        entries = []
+        if nick is not None:
+            nick = nick.encode('utf-8').lower()
+        # Only ASCII words can be found in the raw bytes regardless of case
+        ascii_words = [word.encode('utf-8') for word in words if not _non_ascii_re.search(word)]
+        for timestamp, entry_nick, data in self._get_segments(channel).newest():
+            if nick is not None and entry_nick.lower() != nick:
+                continue
+            # Check the raw bytes first to avoid decoding most messages
+            lowered = data.lower()
+            if not all(word in lowered for word in ascii_words):
+                continue
+            text = data.decode('utf-8', 'replace')
+            if not words <= _words(text):
+                continue
+            entries.append(HistoryEntry(timestamp, channel, entry_nick.decode('utf-8', 'replace'),
+                text))
+            if len(entries) >= limit:
+                break
+        return entries
+
+    def channels(self):
+        return self._channels.keys()
+
+    def flush(self):
+        """Writes buffered spilled messages to disk"""
+        for segments in self._segments.itervalues():
+            segments.flush()
+
+    def close(self):
+        for segments in self._segments.itervalues():
+            segments.close()
+
+    def __len__(self):
+        return sum(len(history) for history in self._channels.itervalues())
+
+    def __repr__(self):
+        return '<HistoryStore(%d channels, %d messages)>' % (len(self._channels), len(self))
@@ -0,0 +1,153 @@
+"""Raw IRC traffic logging used by Flask-IRC"""
+
+import collections
+import sys
+import threading
+import time
+from datetime import datetime
+
+try:
+    from termcolor import colored
+except ImportError:
+    def colored(msg, *args, **kwargs):
+        return msg
+
+DIRECTIONS = ('in', 'out')
+
+
+class IOLogger(object):
+    """Logs raw IRC traffic without blocking the event loop.
+
+    Entries are stored unformatted in a bounded buffer which is drained by a
+    background thread. When the buffer is full, new entries are dropped and
+    counted in :attr:`dropped`. Logging can be toggled per direction and per
+    IRC command at runtime.
+    """
+    def __init__(self, maxsize=10000, filename=None):
+        self.maxsize = maxsize
+        self.filename = filename
+        self.dropped = 0
+        self._dropped_reported = 0
+        self._buffer = collections.deque()
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+        self._running = False
+        self._directions = set()
+        self._ignored_commands = set()
+
+    @property
+    def enabled(self):
+        return bool(self._directions)
+
+    def enable(self, direction=None, cmd=None):
+        """Enables logging for a direction (default: both) or a command"""
+        if cmd is not None:
+            self._ignored_commands.discard(cmd.upper())
+        else:
+            self._directions |= self._get_directions(direction)
+
+    def disable(self, direction=None, cmd=None):
+        """Disables logging for a direction (default: both) or a command"""
+        if cmd is not None:
+            self._ignored_commands.add(cmd.upper())
+        else:
+            self._directions -= self._get_directions(direction)
+
+    def _get_directions(self, direction):
+        if direction is None:
+            return set(DIRECTIONS)
+        if direction not in DIRECTIONS:
+            raise ValueError('Unknown direction')
+        return set((direction,))
+
+    def log(self, direction, line, cmd=None):
+        """Queues a raw line for logging.
+
+        This is called from the event loop for every line so it does nothing
+        besides a few checks and appending to the buffer.
+        """
+        if direction not in self._directions:
+            return
+        if self._ignored_commands:
+            if cmd is None:
+                cmd = _get_command(line)
+            if cmd in self._ignored_commands:
+                return
+        if len(self._buffer) >= self.maxsize:
+            self.dropped += 1
+            return
+        self._buffer.append((time.time(), direction, line))
+        if len(self._buffer) == 1:
+            with self._cond:
+                self._cond.notify()
+
+    def start(self):
+        """Starts the background writer thread"""
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='flask-irc-iolog')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background writer thread after flushing the buffer"""
+        if self._thread is None:
+            return
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        if self.filename:
+            fd = open(self.filename, 'a')
+            color = False
+        else:
+            fd = sys.stdout
+            color = fd.isatty()
+        try:
+            while True:
+                with self._cond:
+                    while self._running and not self._buffer:
+                        self._cond.wait(1)
+                    running = self._running
+                self._flush(fd, color)
+                if not running:
+                    break
+        finally:
+            if fd is not sys.stdout:
+                fd.close()
+
+    def _flush(self, fd, color):
+        lines = []
+        while self._buffer:
+            lines.append(_format_entry(self._buffer.popleft(), color))
+        dropped = self.dropped
+        if dropped != self._dropped_reported:
+            lines.append('[dropped %d lines]' % (dropped - self._dropped_reported))
+            self._dropped_reported = dropped
+        if lines:
+            fd.write('\n'.join(lines) + '\n')
+            fd.flush()
+
+
+def _get_command(line):
+    if line[:1] == ':':
+        line = line.partition(' ')[2]
+    return line.partition(' ')[0].upper()
+
+def _format_entry(entry, color):
+    ts, direction, line = entry
+    now = datetime.fromtimestamp(ts)
+    prefix = '[%s,%03d]' % (now.strftime('%Y-%m-%d %H:%M:%S'), now.microsecond / 1000)
+    if direction == 'in':
+        line = '<< %s' % line
+        if color:
+            line = colored(line, 'blue', attrs=['bold'])
+    else:
+        line = '>> %s' % line
+        if color:
+            line = colored(line, 'green')
+    return '%s %s' % (prefix, line)
@@ -0,0 +1,49 @@
+"""Communication between the gateway and worker processes"""
+
+import struct
+
+# Gateway -> worker
+FRAME_LINE = 1 # a line received from the IRC server
+FRAME_EVENT = 2 # a bot event, e.g. 'connect'
+FRAME_STATE = 3 # JSON-encoded connection state for a restarted worker
+# Worker -> gateway
+FRAME_SEND = 4 # raw data to send to the IRC server
+FRAME_STOP = 5 # stop the bot; the payload is '1' for a graceful stop
+FRAME_UPGRADE = 6 # start a hot upgrade
+
+_HEADER = struct.Struct('!BI')
+
+
+def pack_frame(frame_type, payload=''):
+    return _HEADER.pack(frame_type, len(payload)) + payload
+
+
+class FrameReader(object):
+    """Splits a byte stream into frames
+
+    >>> reader = FrameReader()
+    >>> data = pack_frame(FRAME_LINE, 'PING :x') + pack_frame(FRAME_EVENT, 'ready')
+    >>> reader.feed(data[:3])
+    []
+    >>> reader.feed(data[3:12])
+    [(1, 'PING :x')]
+    >>> reader.feed(data[12:])
+    [(2, 'ready')]
+    """
+    def __init__(self):
+        self._buf = ''
+
+    def feed(self, data):
+        self._buf += data
+        frames = []
+        pos = 0
+        size = _HEADER.size
+        while len(self._buf) - pos >= size:
+            frame_type, length = _HEADER.unpack_from(self._buf, pos)
+            if len(self._buf) - pos - size < length:
+                break
+            pos += size
+            frames.append((frame_type, self._buf[pos:pos + length]))
+            pos += length
+        self._buf = self._buf[pos:]
+        return frames
@@ -1,4 +1,9 @@
 from __future__ import absolute_import
+import os
+import tempfile
+import threading
+
+from .. import profiler
 from ..bot import BotModule, CommandAborted
 from ..bot import module_list as bot_module_list
 
@@ -10,6 +15,11 @@ def admin_init(state=None):
         admin.g = state
     else:
         admin.g.confirm = set()
+    if not hasattr(admin.g, 'profiler'):
+        admin.g.profiler = None
+        admin.g.profile_path = None
+    # The timer of a running scan is stopped when the module is reloaded
+    admin.g.mem_scan = None
 
 @admin.command('module load')
 def module_load(source, channel, module):
@@ -44,9 +54,15 @@ def module_reload(source, channel, module):
     """
     if module not in admin.bot.modules:
         raise CommandAborted('The module %s is not loaded.' % module)
-    if not admin.bot.modules[module].reload():
+    def _reloaded(success):
+        if success:
+            msg = 'The module %s has been reloaded.' % module
+        else:
+            msg = 'The module %s could not be reloaded.' % module
+        admin.bot.send('NOTICE %s :%s' % (source.nick, msg))
+    if not admin.bot.modules[module].reload(_reloaded):
         raise CommandAborted('The module %s could not be reloaded.' % module)
-    return 'The module %s has been reloaded.' % module
+    return 'Reloading module %s...' % module
 
 @admin.command('module list')
 def module_list(source, channel, active=False):
@@ -60,12 +76,148 @@ def module_list(source, channel, active=False):
         lst = sorted(admin.bot.modules)
     else:
         yield 'Available modules (* = active):'
-        modules = set(admin.bot.modules) | set(bot_module_list)
+        modules = (set(admin.bot.modules) | set(bot_module_list) |
+            set(admin.bot.module_registry))
         lst = sorted('%s%s' % (mod, '*' if mod in admin.bot.modules else '')
             for mod in modules)
     for line in lst:
         yield '  ' + line
 
+@admin.command('upgrade')
+def upgrade(source, channel):
+    """Restarts the bot without disconnecting.
+
+    Starts a new bot process which takes over the IRC connection. This
+    process terminates once the new one is running.
+    """
+    if not admin.bot.hot_upgrade():
+        raise CommandAborted('The bot cannot be upgraded right now.')
+    return 'Starting new bot process...'
+
+@admin.command('servers')
+def servers(source, channel):
+    """Shows the configured servers.
+
+    Lists the servers in the order they are preferred along with their
+    priority, measured lag and consecutive failures. The server the bot is
+    connected to is marked with an asterisk.
+    """
+    lag = admin.bot.lag
+    yield 'Current lag: %s' % ('%.3fs' % lag if lag is not None else 'unknown')
+    now = admin.bot.loop.now()
+    for server in sorted(admin.bot.servers, key=lambda s: (s.priority, s.lag or 0)):
+        current = '*' if server is admin.bot._current_server and admin.bot.server else ''
+        server_lag = '%.3fs' % server.lag if server.lag is not None else '-'
+        line = '  %s%s (priority %d, lag %s, %d failures' % (server.address, current,
+            server.priority, server_lag, server.failures)
+        if server.retry_at > now:
+            line += ', avoided for %ds' % (server.retry_at - now)
+        yield line + ')'
+
+def _get_count(count):
+    try:
+        return int(count)
+    except ValueError:
+        raise CommandAborted('The count must be a number.')
+
+def _profile_summary(prof, count, cumulative=False):
+    yield 'Profile of %d samples%s:' % (prof.samples, ' (running)' if prof.running else '')
+    for pct, func in prof.top(_get_count(count), cumulative):
+        yield '  %5.1f%%  %s' % (pct, profiler.format_function(func))
+
+def _stop_profiler():
+    prof = admin.g.profiler
+    prof.stop()
+    directory = admin.bot.app.config['IRC_PROFILE_DIR'] or tempfile.gettempdir()
+    path = os.path.join(directory, 'flask-irc-profile-%d.txt' % prof.started)
+    prof.write(path)
+    admin.g.profile_path = path
+    admin.bot.logger.info('Profile written to %s' % path)
+
+@admin.command('profile start')
+def profile_start(source, channel, interval='5'):
+    """Starts the profiler.
+
+    Starts sampling the bot's main thread every 'interval' milliseconds. The
+    profiler stops automatically after IRC_PROFILE_MAX_DURATION seconds
+    unless it is 0.
+    """
+    if admin.g.profiler and admin.g.profiler.running:
+        raise CommandAborted('The profiler is already running.')
+    try:
+        interval = float(interval) / 1000
+    except ValueError:
+        raise CommandAborted('The interval must be a number.')
+    prof = admin.g.profiler = profiler.SamplingProfiler(threading.current_thread().ident,
+        interval)
+    prof.start()
+    duration = admin.bot.app.config['IRC_PROFILE_MAX_DURATION']
+    if not duration:
+        return 'The profiler has been started.'
+    def _expire():
+        if admin.g.profiler is prof and prof.running:
+            _stop_profiler()
+    admin.bot.after(duration, _expire)
+    return 'The profiler has been started and stops in %ds at most.' % duration
+
+@admin.command('profile stop')
+def profile_stop(source, channel, count='5'):
+    """Stops the profiler.
+
+    Stops the profiler, shows the functions with the most samples and writes
+    the full profile to a file.
+    """
+    if not admin.g.profiler or not admin.g.profiler.running:
+        raise CommandAborted('The profiler is not running.')
+    _stop_profiler()
+    for line in _profile_summary(admin.g.profiler, count):
+        yield line
+    yield 'Full profile: %s' % admin.g.profile_path
+
+@admin.command('profile top')
+def profile_top(source, channel, count='10', cumulative=False):
+    """Shows the functions with the most samples.
+
+    Shows the results of the running or last profiler run. If the
+    'cumulative' switch is present, time spent in called functions is
+    included.
+    """
+    prof = admin.g.profiler
+    if not prof:
+        raise CommandAborted('The profiler has not been run yet.')
+    for line in _profile_summary(prof, count, cumulative):
+        yield line
+
+@admin.command('mem top')
+def mem_top(source, channel, count='10'):
+    """Shows the memory usage per module.
+
+    Measures the size of the objects reachable from each module's state,
+    handlers and commands in the background and shows the largest modules
+    once finished.
+    """
+    if admin.g.mem_scan is not None:
+        raise CommandAborted('The memory usage is already being measured.')
+    count = _get_count(count)
+    bot = admin.bot
+    roots = [('module %s' % module.name, [module.g, module._handlers, module._batch_handlers,
+                                          module._events, module._commands, module._matchers,
+                                          module._timers])
+             for module in bot.modules.itervalues()]
+    exclude = [bot, bot.app] + bot.modules.values()
+    scan = admin.g.mem_scan = profiler.ModuleSizes(
+        roots, admin.bot.app.config['IRC_PROFILE_MEM_CHUNK'], exclude)
+    def _step():
+        if not scan.step():
+            admin.after(0, _step) # continue after handling pending events
+            return
+        admin.g.mem_scan = None
+        bot.send('NOTICE %s :Memory used by %d objects:' % (source.nick, scan.total))
+        for size, name in scan.top(count):
+            bot.send('NOTICE %s :  %8.1f KiB  %s' % (source.nick, size / 1024.0, name))
+    admin.after(0, _step)
+    return 'Measuring the memory usage of %d modules...' % len(roots)
+
 @admin.command('die', greedy=True)
 def die(source, channel, reason, force=False):
     """Terminates the bot."""
@@ -82,3 +234,25 @@ def die(source, channel, reason, force=False):
             admin.g.confirm.remove(source.source)
         admin.bot.after(5, _expire)
         return 'Re-run this command within five seconds to confirm it.'
+
+@admin.command('iolog')
+def iolog(source, channel, state, direction=None, cmd=None):
+    """Toggles raw traffic logging.
+
+    Enables ('on') or disables ('off') logging of raw IRC traffic. Use the
+    'direction' option ('in' or 'out') to toggle only one direction or the
+    'cmd' option to toggle logging of a single IRC command.
+    """
+    io_log = admin.bot.io_log
+    if state not in ('on', 'off'):
+        raise CommandAborted('The state must be either on or off.')
+    try:
+        if state == 'on':
+            io_log.enable(direction, cmd)
+            io_log.start()
+        else:
+            io_log.disable(direction, cmd)
+    except ValueError, e:
+        raise CommandAborted(str(e))
+    return 'Raw traffic logging is %s (%d lines dropped so far).' % (
+        'enabled' if io_log.enabled else 'disabled', io_log.dropped)
@@ -0,0 +1,155 @@
+"""Profiling helpers used by Flask-IRC"""
+
+import collections
+import gc
+import itertools
+import os
+import sys
+import threading
+import time
+import types
+
+
+class SamplingProfiler(object):
+    """A statistical profiler sampling the stack of a single thread.
+
+    A background thread records the current stack of the profiled thread
+    every `interval` seconds. This keeps the overhead low and independent
+    of the number of function calls, at the cost of exact timings.
+    """
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self.started = None
+        self.stopped = None
+        self._own = collections.Counter() # function -> samples on top of the stack
+        self._total = collections.Counter() # function -> samples anywhere in the stack
+        self._stacks = collections.Counter() # full stack -> samples
+        self._running = False
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        self._running = True
+        self.started = time.time()
+        self._thread = threading.Thread(target=self._run, name='flask-irc-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        self.stopped = time.time()
+
+    def _run(self):
+        while self._running:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self._sample(frame)
+            time.sleep(self.interval)
+
+    def _sample(self, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        self.samples += 1
+        self._own[stack[0]] += 1
+        for func in set(stack):
+            self._total[func] += 1
+        self._stacks[tuple(reversed(stack))] += 1
+
+    def top(self, count=10, cumulative=False):
+        """Returns the most frequently sampled functions.
+
+        Each item is a `(percentage, function)` tuple; functions are
+        `(filename, lineno, name)` tuples.
+        """
+        counter = self._total if cumulative else self._own
+        samples = self.samples or 1
+        return [(100.0 * num / samples, func) for func, num in counter.most_common(count)]
+
+    def write(self, path):
+        """Writes the full profile to a file.
+
+        Besides the function tables, the file contains all sampled stacks
+        in the "collapsed" format used by flamegraph tools.
+        """
+        with open(path, 'w') as f:
+            duration = (self.stopped or time.time()) - self.started
+            f.write('# %d samples in %.1fs\n' % (self.samples, duration))
+            for title, cumulative in (('Own', False), ('Cumulative', True)):
+                f.write('\n# %s time\n' % title)
+                for pct, func in self.top(None, cumulative):
+                    f.write('%6.2f%%  %s\n' % (pct, format_function(func)))
+            f.write('\n# Stacks\n')
+            for stack, num in self._stacks.most_common():
+                f.write('%s %d\n' % (';'.join(func[2] for func in stack), num))
+
+
+def format_function(func):
+    filename, lineno, name = func
+    return '%s (%s:%d)' % (name, os.path.basename(filename), lineno)
+
+
+# Following these would reach most of the interpreter: modules and classes
+# are skipped, functions are counted without following their globals
+_SKIPPED_TYPES = (types.ModuleType, type, types.ClassType)
+_LEAF_TYPES = (types.FunctionType, types.MethodType, types.BuiltinFunctionType,
+               types.CodeType, types.FrameType)
+
+
+class ModuleSizes(object):
+    """Sums the sizes of the objects reachable from each bot module.
+
+    `roots` is a list of `(name, objects)` tuples, e.g. the state, handlers
+    and commands of each bot module. Objects reachable from several roots
+    are only counted for the first one; the objects in `exclude` are neither
+    counted nor followed. Since this takes a while for large states, the
+    objects are processed in chunks of `chunk_size` by calling `step()`
+    repeatedly, e.g. from a timer, so the event loop can run in between.
+    A `chunk_size` of 0 processes all objects in the first step.
+    """
+    def __init__(self, roots, chunk_size=10000, exclude=()):
+        self.chunk_size = chunk_size
+        self.sizes = collections.Counter()
+        self.total = 0 # objects counted so far
+        self._roots = list(roots)
+        self._name = None
+        self._stack = []
+        self._seen = set(id(obj) for obj in exclude)
+        self._seen.add(id(self))
+
+    def step(self):
+        """Processes the next chunk and returns True once all objects are done"""
+        seen = self._seen
+        for _ in (xrange(self.chunk_size) if self.chunk_size else itertools.count()):
+            if not self._stack:
+                if not self._roots:
+                    self._seen = set()
+                    return True
+                self._name, objects = self._roots.pop(0)
+                self._stack = list(objects)
+                self.sizes[self._name] += 0
+                continue
+            obj = self._stack.pop()
+            if id(obj) in seen or isinstance(obj, _SKIPPED_TYPES):
+                continue
+            seen.add(id(obj))
+            self.total += 1
+            try:
+                self.sizes[self._name] += sys.getsizeof(obj)
+            except TypeError:
+                pass
+            if not isinstance(obj, _LEAF_TYPES):
+                self._stack.extend(gc.get_referents(obj))
+        return False
+
+    def top(self, count=10):
+        """Returns a list of `(size, name)` tuples"""
+        return [(size, name) for name, size in self.sizes.most_common(count)]
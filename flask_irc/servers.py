@@ -0,0 +1,107 @@
+"""Selection of the IRC server to connect to"""
+
+# Weight of a new lag sample in the moving average
+LAG_SMOOTHING = 0.3
+# Seconds a server is avoided after failing; doubled for consecutive failures
+RETRY_DELAY = 30
+
+
+class Server(object):
+    def __init__(self, host, port, ssl=None, priority=0):
+        self.host = host
+        self.port = port
+        self.ssl = ssl # None uses IRC_SERVER_SSL
+        self.priority = priority
+        self.lag = None # moving average in seconds
+        self.failures = 0 # consecutive failures
+        self.retry_at = 0
+
+    @property
+    def address(self):
+        return '%s:%d' % (self.host, self.port)
+
+    def __repr__(self):
+        return '<Server(%s, priority=%d)>' % (self.address, self.priority)
+
+
+def parse_server(entry):
+    """Creates a Server from a config entry.
+
+    >>> parse_server('irc.example.net:6697')
+    <Server(irc.example.net:6697, priority=0)>
+    >>> parse_server({'host': 'irc.example.org', 'priority': 1})
+    <Server(irc.example.org:6667, priority=1)>
+    """
+    if isinstance(entry, basestring):
+        host, _, port = entry.rpartition(':')
+        if not host or not port.isdigit():
+            raise ValueError('Invalid server address: %s' % entry)
+        return Server(host, int(port))
+    return Server(entry['host'], entry.get('port', 6667), entry.get('ssl'),
+        entry.get('priority', 0))
+
+
+class ServerPool(object):
+    """Picks the healthiest server to connect to.
+
+    Servers with a lower priority value are preferred; among servers with
+    the same priority the one with the lowest lag wins. Servers without a
+    lag measurement are tried before slower ones. After a failure a server
+    is skipped for a delay doubling with every consecutive failure, unless
+    all servers are in that state.
+
+    >>> pool = ServerPool([Server('a', 1), Server('b', 2), Server('c', 3, priority=1)], 10)
+    >>> pool.select(0).host
+    'a'
+    >>> pool.record_lag(pool.servers[0], 0.5)
+    >>> pool.select(0).host
+    'b'
+    >>> pool.record_lag(pool.servers[1], 0.2)
+    >>> pool.select(0).host
+    'b'
+    >>> pool.failure(pool.servers[1], 0)
+    >>> pool.select(5).host
+    'a'
+    >>> pool.failure(pool.servers[0], 5)
+    >>> pool.select(6).host
+    'c'
+    >>> pool.failure(pool.servers[2], 6)
+    >>> pool.select(7).host # all failed; retry the one available first
+    'b'
+    >>> pool.success(pool.servers[1])
+    >>> pool.servers[1].failures
+    0
+    """
+    def __init__(self, servers, retry_delay=RETRY_DELAY, max_retry_delay=300):
+        if not servers:
+            raise ValueError('No servers configured')
+        self.servers = servers
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+    def select(self, now):
+        available = [server for server in self.servers if server.retry_at <= now]
+        if not available:
+            return min(self.servers, key=lambda server: server.retry_at)
+        return min(available, key=lambda server: (server.priority, server.lag or 0))
+
+    def record_lag(self, server, lag):
+        if server.lag is None:
+            server.lag = lag
+        else:
+            server.lag += LAG_SMOOTHING * (lag - server.lag)
+
+    def success(self, server):
+        server.failures = 0
+        server.retry_at = 0
+
+    def failure(self, server, now):
+        server.failures += 1
+        delay = self.retry_delay * 2 ** (server.failures - 1)
+        server.retry_at = now + min(delay, self.max_retry_delay)
+
+    def __iter__(self):
+        return iter(self.servers)
+
+    def __repr__(self):
+        return '<ServerPool(%s)>' % ', '.join(server.address for server in self.servers)
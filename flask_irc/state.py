@@ -0,0 +1,181 @@
+"""Persistent module state used by Flask-IRC"""
+
+import cPickle as pickle
+import os
+import Queue
+import struct
+import threading
+
+_SNAPSHOT_HEADER = struct.Struct('!Q') # generation
+_RECORD_HEADER = struct.Struct('!IQ') # length, generation
+
+
+class StateWriter(object):
+    """Performs file operations of state stores in a background thread"""
+    def __init__(self):
+        self._queue = Queue.Queue()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='flask-irc-state')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the thread after all pending writes have been performed"""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def flush(self):
+        """Waits until all pending writes have been performed"""
+        if self._thread is None:
+            return
+        done = threading.Event()
+        self._queue.put((done.set, ()))
+        done.wait()
+
+    def submit(self, func, *args):
+        self._queue.put((func, args))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            func, args = item
+            func(*args)
+
+
+class StateStore(object):
+    """Stores the state of a module on disk.
+
+    Changed attributes are appended to a log file. Once the log grows larger
+    than `compact_size`, a snapshot containing the whole state is written
+    and the log is truncated. Both files contain length-prefixed pickled
+    records, either `(key, value)` or `(key,)` for deleted keys.
+
+    Every snapshot starts a new generation which is stored in the snapshot
+    and in each log record, so records written before the snapshot are
+    ignored if the process died before the log was truncated.
+    """
+    def __init__(self, directory, name, writer, logger, compact_size=1024 * 1024):
+        self.name = name
+        self.logger = logger
+        self.compact_size = compact_size
+        self._writer = writer
+        self._snapshot_path = os.path.join(directory, '%s.snapshot' % name)
+        self._log_path = os.path.join(directory, '%s.log' % name)
+        self._generation = 0
+        try:
+            self._log_size = os.path.getsize(self._log_path)
+        except OSError:
+            self._log_size = 0
+
+    def load(self):
+        """Returns the stored state as a dict"""
+        data = {}
+        buf = self._read_file(self._snapshot_path)
+        if len(buf) >= _SNAPSHOT_HEADER.size:
+            self._generation, = _SNAPSHOT_HEADER.unpack_from(buf)
+            self._apply_records(data, buf, _SNAPSHOT_HEADER.size, self._snapshot_path)
+        buf = self._read_file(self._log_path)
+        end = self._apply_records(data, buf, 0, self._log_path)
+        if end != len(buf):
+            # Records appended later must not end up behind a broken one
+            self._truncate_log(end)
+        return data
+
+    def _read_file(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except IOError:
+            return ''
+
+    def _apply_records(self, data, buf, pos, path):
+        """Applies the valid records and returns the position after them"""
+        size = _RECORD_HEADER.size
+        while pos + size <= len(buf):
+            length, generation = _RECORD_HEADER.unpack_from(buf, pos)
+            if pos + size + length > len(buf):
+                break
+            try:
+                record = pickle.loads(buf[pos + size:pos + size + length])
+            except Exception:
+                break
+            pos += size + length
+            if generation < self._generation:
+                continue # written before the snapshot
+            if len(record) == 2:
+                data[record[0]] = record[1]
+            else:
+                data.pop(record[0], None)
+        if pos != len(buf):
+            # Most likely the process died while writing a record
+            self.logger.warn('Ignoring incomplete or corrupt data in %s' % path)
+        return pos
+
+    def _truncate_log(self, size):
+        try:
+            with open(self._log_path, 'r+b') as f:
+                f.truncate(size)
+            self._log_size = size
+        except IOError, e:
+            self.logger.error('Could not truncate state log: %s' % e)
+
+    def save(self, state):
+        """Writes the changed attributes of a module state.
+
+        The attributes are serialized immediately so the written data is
+        consistent; only the file operations happen in the background.
+        """
+        dirty = state._pop_dirty()
+        if not dirty:
+            return
+        items = state._items()
+        data = ''.join(self._serialize(key, items) for key in dirty)
+        self._log_size += len(data)
+        if self._log_size <= self.compact_size:
+            self._writer.submit(self._append, data)
+        else:
+            self._generation += 1
+            snapshot = _SNAPSHOT_HEADER.pack(self._generation) + ''.join(
+                self._serialize(key, items) for key in items)
+            self._log_size = 0
+            self._writer.submit(self._compact, snapshot)
+
+    def _serialize(self, key, items):
+        record = (key, items[key]) if key in items else (key,)
+        try:
+            data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            self.logger.error('Could not serialize state attribute %s: %s' % (key, e))
+            return ''
+        return _RECORD_HEADER.pack(len(data), self._generation) + data
+
+    def _append(self, data):
+        try:
+            with open(self._log_path, 'ab') as f:
+                f.write(data)
+        except IOError, e:
+            self.logger.error('Could not write state log: %s' % e)
+
+    def _compact(self, snapshot):
+        tmp_path = self._snapshot_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self._snapshot_path)
+            open(self._log_path, 'wb').close()
+        except (IOError, OSError), e:
+            self.logger.error('Could not write state snapshot: %s' % e)
+
+    def __repr__(self):
+        return '<StateStore(%s)>' % self.name
@@ -1,13 +1,25 @@
 """Various structures used by Flask-IRC"""
 
+import collections
 import itertools
+import re
+import threading
+import time
 
 from .utils import to_unicode
 
+_TAG_ESCAPES = {':': ';', 's': ' ', 'r': '\r', 'n': '\n'}
+_tag_escape_re = re.compile(r'\\(.?)')
+
 class IRCMessage(object):
     def __init__(self, line):
         line = to_unicode(line)
         self.line = line
+        if line[0] == '@':
+            tags, _, line = line[1:].partition(' ')
+            self.tags = _parse_tags(tags)
+        else:
+            self.tags = {}
         if line[0] == ':':
             source, _, line = line[1:].partition(' ')
             self.source = IRCSource(source)
@@ -39,6 +51,22 @@ class IRCMessage(object):
             return '<IRCMessage(%r)>' % self.line
 
 
+def _parse_tags(tags):
+    """Parses IRCv3 message tags
+
+    >>> sorted(_parse_tags('batch=yXNAbvnRHTRBv;aaa=a\\sb\\:c;+example.com/foo').items())
+    [('+example.com/foo', ''), ('aaa', 'a b;c'), ('batch', 'yXNAbvnRHTRBv')]
+    """
+    parsed = {}
+    for tag in tags.split(';'):
+        key, _, value = tag.partition('=')
+        if '\\' in value:
+            value = _tag_escape_re.sub(lambda m: _TAG_ESCAPES.get(m.group(1), m.group(1)),
+                value)
+        parsed[key] = value
+    return parsed
+
+
 class IRCSource(object):
     def __init__(self, source):
         self.source = source
@@ -205,3 +233,473 @@ class CommandStorage(object):
 
     def __repr__(self):
         return '<CommandStorage(%r)>' % map(' '.join, self._dict)
+
+
+class PatternSet(object):
+    """Stores regular expressions and matches all of them in a single pass.
+
+    The patterns are compiled into one combined regex which is rebuilt
+    lazily whenever patterns are added or removed. Matching returns the
+    value and match object of every pattern matching the given string.
+
+    >>> ps = PatternSet()
+    >>> ps.add(r'https?://\S+', 'url')
+    >>> ps.add(r'(\w+)\+\+', 'karma')
+    >>> ps.add(r'beer', 'beer', re.I)
+    >>> len(ps)
+    3
+    >>> [(value, m.group(0)) for value, m in ps.match('foo++ http://x.y')]
+    [('url', 'http://x.y'), ('karma', 'foo++')]
+    >>> [(value, m.group(0)) for value, m in ps.match('bar++ BEER')]
+    [('karma', 'bar++'), ('beer', 'BEER')]
+    >>> ps.match('nothing')
+    []
+    >>> ps.remove(r'(\w+)\+\+', 'karma')
+    >>> [value for value, m in ps.match('foo++ http://x.y')]
+    ['url']
+    >>> ps.remove(r'(\w+)\+\+', 'karma')
+    Traceback (most recent call last):
+      ...
+    KeyError: 'karma'
+
+    A value may be registered with several patterns; removing one of them
+    keeps the others.
+
+    >>> ps.add(r'cheers', 'beer')
+    >>> [value for value, m in ps.match('Beer, cheers')]
+    ['beer', 'beer']
+    >>> ps.remove(r'beer', 'beer', re.I)
+    >>> [m.group(0) for value, m in ps.match('Beer, cheers')]
+    ['cheers']
+    >>> ps.remove(r'cheers', 'beer')
+    >>> len(ps)
+    1
+
+    Inline flags apply to the whole pattern, so patterns using them are
+    matched separately; all other patterns use exactly the given flags.
+
+    >>> ps.add(r'ale(?i)', 'ale')
+    >>> ps.add(r'^stout$', 'stout')
+    >>> [value for value, m in ps.match('ALE')]
+    ['ale']
+    >>> [value for value, m in ps.match('stout')]
+    ['stout']
+    >>> [value for value, m in ps.match('a\\nstout http://x.y')]
+    ['url']
+    """
+    # Patterns using these cannot be safely merged with other patterns since
+    # group numbers and inline flags would affect the combined pattern.
+    _standalone_re = re.compile(r'\\[1-9]|\(\?[iLmsux]+\)')
+
+    def __init__(self):
+        self._entries = []
+        self._compiled = None
+
+    def add(self, pattern, value, flags=0):
+        self._entries.append((pattern, flags, re.compile(pattern, flags), value))
+        self._compiled = None
+
+    def remove(self, pattern, value, flags=0):
+        """Removes a pattern added with the same arguments"""
+        for i, entry in enumerate(self._entries):
+            if entry[0] == pattern and entry[1] == flags and entry[3] == value:
+                del self._entries[i]
+                self._compiled = None
+                return
+        raise KeyError(value)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __nonzero__(self):
+        return bool(self._entries)
+
+    def _build(self):
+        groups = {}
+        standalone = []
+        for i, (pattern, flags, regex, value) in enumerate(self._entries):
+            if self._standalone_re.search(pattern):
+                standalone.append(i)
+            else:
+                groups.setdefault(flags, []).append(i)
+        combined = []
+        for flags, indexes in groups.iteritems():
+            try:
+                combined.append(self._combine(indexes, flags))
+            except re.error:
+                # Most likely a group name used by more than one pattern
+                standalone += indexes
+        self._compiled = combined, sorted(standalone)
+
+    def _combine(self, indexes, flags):
+        patterns = [self._entries[i][0] for i in indexes]
+        # The alternation rejects non-matching strings quickly. Since it only
+        # finds one pattern per position, the lookaheads are used to find all
+        # matching patterns when it matched. They skip ahead with [\s\S]
+        # instead of `.` so both regexes use exactly the same flags.
+        quick = re.compile('|'.join('(?:%s)' % p for p in patterns), flags)
+        detect = re.compile(''.join(r'(?:(?=[\s\S]*?(?P<_p%d>%s)))?' % (i, p)
+            for i, p in zip(indexes, patterns)), flags)
+        return quick, detect
+
+    def match(self, string):
+        if self._compiled is None:
+            self._build()
+        combined, standalone = self._compiled
+        found = []
+        for quick, detect in combined:
+            if not quick.search(string):
+                continue
+            groups = detect.match(string).groupdict()
+            found += (int(name[2:]) for name, value in groups.iteritems()
+                if name.startswith('_p') and value is not None)
+        found += (i for i in standalone if self._entries[i][2].search(string))
+        matches = []
+        for i in sorted(found):
+            regex, value = self._entries[i][2:]
+            matches.append((value, regex.search(string)))
+        return matches
+
+    def __repr__(self):
+        return '<PatternSet(%r)>' % [entry[0] for entry in self._entries]
+
+
+class TokenBuckets(object):
+    """Stores token buckets for a bounded number of keys.
+
+    Each key gets a bucket holding up to `capacity` tokens which is refilled
+    with `rate` tokens per second. Only the `maxsize` most recently used
+    buckets are kept; evicting a bucket is harmless since a new bucket starts
+    full.
+
+    >>> tb = TokenBuckets(3, 1, maxsize=2)
+    >>> tb.consume('a', 2, now=0), tb.consume('a', 1, now=0), tb.consume('a', 1, now=0)
+    (True, True, False)
+    >>> tb.consume('a', 1, now=1.5)
+    True
+    >>> tb.consume('a', 1, now=1.5)
+    False
+    >>> tb.consume('b', now=2), tb.consume('c', now=2)
+    (True, True)
+    >>> len(tb), 'a' in tb
+    (2, False)
+    >>> tb.consume('a', 3, now=2)
+    True
+    """
+    def __init__(self, capacity, rate, maxsize=1000):
+        self.capacity = capacity
+        self.rate = rate
+        self.maxsize = maxsize
+        self._buckets = collections.OrderedDict()
+
+    def consume(self, key, cost=1, now=None):
+        """Takes `cost` tokens from the key's bucket if it has enough"""
+        if now is None:
+            now = time.time()
+        # Larger costs could never be satisfied
+        cost = min(cost, self.capacity)
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            tokens = self.capacity
+            if len(self._buckets) >= self.maxsize:
+                self._buckets.popitem(last=False)
+        else:
+            tokens, last = bucket
+            tokens = min(self.capacity, tokens + (now - last) * self.rate)
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+        self._buckets[key] = (tokens, now)
+        return allowed
+
+    def __contains__(self, key):
+        return key in self._buckets
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def __repr__(self):
+        return '<TokenBuckets(%d/%d)>' % (len(self._buckets), self.maxsize)
+
+
+class TTLCache(object):
+    """A bounded cache whose entries expire after a per-entry TTL.
+
+    Keys are tuples so entries can be removed by key prefix. When the cache
+    is full the least recently used entry is evicted.
+
+    >>> cache = TTLCache(maxsize=2)
+    >>> cache.set(('mod', 'a'), 'x', 10, now=0)
+    >>> cache.get(('mod', 'a'), now=5)
+    'x'
+    >>> cache.get(('mod', 'a'), now=11) is None
+    True
+    >>> cache.set(('mod', 'a'), 'x', 10, now=0)
+    >>> cache.set(('mod', 'b'), 'y', 10, now=0)
+    >>> cache.set(('other', 'c'), 'z', 10, now=0)
+    >>> len(cache), cache.get(('mod', 'a'), now=0)
+    (2, None)
+    >>> cache.discard_prefix(('mod',))
+    >>> len(cache), cache.get(('other', 'c'), now=0)
+    (1, 'z')
+    """
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+
+    def get(self, key, default=None, now=None):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        if now is None:
+            now = time.time()
+        expires, value = entry
+        if expires <= now:
+            return default
+        self._entries[key] = entry
+        return value
+
+    def set(self, key, value, ttl, now=None):
+        if now is None:
+            now = time.time()
+        self._entries.pop(key, None)
+        if len(self._entries) >= self.maxsize:
+            self._entries.popitem(last=False)
+        self._entries[key] = (now + ttl, value)
+
+    def discard_prefix(self, prefix):
+        """Removes all entries whose key starts with the given tuple"""
+        size = len(prefix)
+        for key in [key for key in self._entries if key[:size] == prefix]:
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return '<TTLCache(%d/%d)>' % (len(self._entries), self.maxsize)
+
+
+class MaskSet(object):
+    """Stores `nick!ident@host` masks and matches sources against all of them.
+
+    The masks may contain `*` and `?` wildcards and are matched case
+    insensitively. Instead of checking every mask, each mask is indexed by
+    its most specific literal part: the whole mask, the host, a host suffix
+    (`*.example.com`), a host prefix (`192.168.*`), the ident or the nick.
+    Only masks without any of these are checked by a combined regex. The
+    results are cached per source until the masks change.
+
+    >>> masks = MaskSet()
+    >>> masks.add('spammer!*@*')
+    >>> masks.add('*!*@*.example.com', 'example')
+    >>> masks.add('*!*@192.168.*')
+    >>> masks.add('*!bot?@*')
+    >>> masks.add('*bot*!*@*', 'general')
+    >>> masks.match('Spammer!foo@bar')
+    [('spammer!*@*', True)]
+    >>> masks.match(IRCSource('alice!alice@host.Example.com'))
+    [('*!*@*.example.com', 'example')]
+    >>> masks.match('carol!bot1@192.168.0.1')
+    [('*!*@192.168.*', True), ('*!bot?@*', True)]
+    >>> masks.match('robot!x@y')
+    [('*bot*!*@*', 'general')]
+    >>> masks.match('alice!alice@example.com')
+    []
+    >>> masks.remove('*!*@*.example.com')
+    >>> masks.match('alice!alice@host.example.com')
+    []
+    >>> 'SPAMMER' in masks
+    True
+    """
+    _wildcard_re = re.compile(r'[*?]')
+
+    def __init__(self, cache_size=1000):
+        self.cache_size = cache_size
+        self._masks = {} # mask -> (regex, value)
+        self._exact = {}
+        self._by_host = {}
+        self._by_suffix = {} # e.g. '.example.com'
+        self._by_prefix = {} # e.g. '192.168.'
+        self._by_ident = {}
+        self._by_nick = {}
+        self._general = set()
+        self._general_re = None
+        self._cache = collections.OrderedDict()
+
+    @staticmethod
+    def normalize(mask):
+        """Completes a mask like IRC servers do, e.g. 'nick' -> 'nick!*@*'
+
+        >>> [MaskSet.normalize(m) for m in ('Nick', 'nick!user', 'user@host', '*.host')]
+        ['nick!*@*', 'nick!user@*', '*!user@host', '*!*@*.host']
+        """
+        mask = mask.lower()
+        if '!' in mask:
+            if '@' not in mask:
+                mask += '@*'
+        elif '@' in mask:
+            mask = '*!' + mask
+        elif '.' in mask:
+            mask = '*!*@' + mask
+        else:
+            mask += '!*@*'
+        return mask
+
+    def _get_index(self, mask):
+        nick, _, ident_host = mask.partition('!')
+        ident, _, host = ident_host.partition('@')
+        wildcard = self._wildcard_re.search
+        if not wildcard(mask):
+            return self._exact, mask
+        if not wildcard(host):
+            return self._by_host, host
+        if host.startswith('*.') and not wildcard(host[1:]):
+            return self._by_suffix, host[1:]
+        if host.endswith('.*') and not wildcard(host[:-1]):
+            return self._by_prefix, host[:-1]
+        if not wildcard(ident):
+            return self._by_ident, ident
+        if not wildcard(nick):
+            return self._by_nick, nick
+        return None, None
+
+    def add(self, mask, value=True):
+        mask = self.normalize(mask)
+        if mask not in self._masks:
+            index, key = self._get_index(mask)
+            if index is None:
+                self._general.add(mask)
+                self._general_re = None
+            else:
+                index.setdefault(key, set()).add(mask)
+        self._masks[mask] = (re.compile(_mask_to_regex(mask) + r'\Z', re.S), value)
+        self._cache.clear()
+
+    def remove(self, mask):
+        mask = self.normalize(mask)
+        del self._masks[mask]
+        index, key = self._get_index(mask)
+        if index is None:
+            self._general.discard(mask)
+            self._general_re = None
+        else:
+            index[key].discard(mask)
+            if not index[key]:
+                del index[key]
+        self._cache.clear()
+
+    def match(self, source):
+        """Returns `(mask, value)` tuples of all masks matching a source.
+
+        The source is either an IRCSource or a `nick!ident@host` string.
+        """
+        if not isinstance(source, basestring):
+            if not source.complete:
+                return []
+            source = '%s!%s@%s' % (source.nick, source.ident, source.host)
+        source = source.lower()
+        matches = self._cache.pop(source, None)
+        if matches is None:
+            matches = self._match(source)
+            if len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)
+        self._cache[source] = matches
+        return matches
+
+    def _match(self, source):
+        nick, _, ident_host = source.partition('!')
+        ident, _, host = ident_host.partition('@')
+        candidates = []
+        for index, key in ((self._exact, source), (self._by_host, host),
+                           (self._by_ident, ident), (self._by_nick, nick)):
+            candidates += index.get(key, ())
+        pos = host.find('.')
+        while pos != -1:
+            candidates += self._by_suffix.get(host[pos:], ())
+            candidates += self._by_prefix.get(host[:pos + 1], ())
+            pos = host.find('.', pos + 1)
+        if self._general:
+            if self._general_re is None:
+                self._general_re = re.compile(r'(?:%s)\Z' % '|'.join(
+                    _mask_to_regex(mask) for mask in self._general), re.S)
+            if self._general_re.match(source):
+                candidates += self._general
+        return [(mask, self._masks[mask][1]) for mask in sorted(set(candidates))
+                if self._masks[mask][0].match(source)]
+
+    def __contains__(self, mask):
+        return self.normalize(mask) in self._masks
+
+    def __iter__(self):
+        return iter(self._masks)
+
+    def __len__(self):
+        return len(self._masks)
+
+    def __repr__(self):
+        return '<MaskSet(%d masks)>' % len(self._masks)
+
+
+def _mask_to_regex(mask):
+    """Translates IRC wildcards; unlike fnmatch, brackets have no special meaning"""
+    return ''.join('.*' if c == '*' else '.' if c == '?' else re.escape(c) for c in mask)
+
+
+class FutureTimeout(Exception): pass
+
+class Future(object):
+    """The result of an operation performed in another thread.
+
+    >>> f = Future()
+    >>> f.done()
+    False
+    >>> f.result(timeout=0)
+    Traceback (most recent call last):
+      ...
+    FutureTimeout
+    >>> f.set_result(42)
+    >>> f.done(), f.result()
+    (True, 42)
+    >>> f = Future()
+    >>> f.set_exception(ValueError('failed'))
+    >>> f.result()
+    Traceback (most recent call last):
+      ...
+    ValueError: failed
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def set_result(self, result):
+        self._result = result
+        self._event.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._event.set()
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise FutureTimeout
+        return self._exception
+
+    def result(self, timeout=None):
+        if self.exception(timeout) is not None:
+            raise self._exception
+        return self._result
+
+    def __repr__(self):
+        if not self.done():
+            return '<Future(pending)>'
+        elif self._exception is not None:
+            return '<Future(exception=%r)>' % self._exception
+        return '<Future(result=%r)>' % self._result
@@ -0,0 +1,14 @@
+import flask
+import pyev
+
+from flask_irc import Bot
+
+
+def make_bot(**config):
+    """Returns a bot with its own event loop which is not connected"""
+    app = flask.Flask(__name__)
+    app.config.update(config)
+    bot = Bot(app)
+    bot.loop = pyev.Loop()
+    bot._init_loop()
+    return bot
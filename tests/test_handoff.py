@@ -0,0 +1,94 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from flask_irc import handoff
+from flask_irc.structs import Future
+from helpers import make_bot
+
+
+class HandoffTest(unittest.TestCase):
+    state = {'nick': 'FlaskBot', 'server': 'irc.example.net', 'isupport': {'CHANTYPES': '#'},
+             'channels': ['#chan'], 'caps': ['batch'], 'ready': True,
+             'address': 'irc.example.net:6697', 'lag': 0.25,
+             'readbuf': ':x!y@z PRIVMSG #chan :caf\xe9 partial',
+             'writebuf': 'PRIVMSG #chan :\xff\xfe pending\r\n'}
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'handoff.sock')
+        # `irc` is the connection to be handed over, `server` its peer
+        self.irc, self.server = socket.socketpair()
+
+    def tearDown(self):
+        self.irc.close()
+        self.server.close()
+        shutil.rmtree(self.tmpdir)
+
+    def hand_over(self, receive):
+        listener = handoff.listen(self.path)
+        result = {}
+        def _receive():
+            result['value'] = receive(self.path)
+        thread = threading.Thread(target=_receive)
+        thread.start()
+        conn, _ = listener.accept()
+        try:
+            self.assertTrue(handoff.send_connection(conn, self.irc, self.state))
+        finally:
+            conn.close()
+            listener.close()
+        thread.join(10)
+        # The old process stops using the socket once the handoff succeeded
+        self.irc.close()
+        return result['value']
+
+    def test_round_trip(self):
+        sock, state = self.hand_over(handoff.receive_connection)
+        try:
+            for key, value in self.state.iteritems():
+                self.assertEqual(state[key], value)
+            sock.sendall('PONG :x\r\n')
+            self.assertEqual(self.server.recv(100), 'PONG :x\r\n')
+            self.server.sendall('PING :y\r\n')
+            self.assertEqual(sock.recv(100), 'PING :y\r\n')
+        finally:
+            sock.close()
+
+    def test_receive_without_listener_fails(self):
+        with self.assertRaises(socket.error):
+            handoff.receive_connection(self.path, timeout=0.3)
+
+    def test_resumed_bot_counts_inherited_output(self):
+        bot = make_bot(IRC_SERVERS=['irc.example.org:6667', 'irc.example.net:6697'])
+        state = self.hand_over(lambda path: bot._resume_connection(path))
+        self.assertEqual(state['nick'], 'FlaskBot')
+        self.assertEqual(bot.nick, 'FlaskBot')
+        self.assertEqual(bot.channels, set(['#chan']))
+        self.assertEqual(bot._current_server.address, 'irc.example.net:6697')
+        self.assertEqual(bot._current_server.lag, 0.25)
+        self.assertEqual(bot.lag, 0.25)
+        self.assertEqual(bot._readbuf, self.state['readbuf'])
+        future = Future()
+        bot._send_confirmed('PRIVMSG #chan :new', future)
+        self.assertEqual(bot._deliveries[0][0],
+                         len(self.state['writebuf']) + len('PRIVMSG #chan :new\r\n'))
+        # Writing only the inherited output does not confirm the new line
+        inherited = len(self.state['writebuf'])
+        pending = bot._writebuf
+        bot._writebuf = pending[:inherited]
+        bot._io_write()
+        self.assertFalse(future.done())
+        bot._writebuf = pending[inherited:]
+        bot._io_write()
+        self.assertTrue(future.done())
+        self.assertEqual(self.server.recv(200),
+                         self.state['writebuf'] + 'PRIVMSG #chan :new\r\n')
+        bot.sock.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import uuid
+
+import pyev
+
+from helpers import make_bot
+
+MODULE_CODE = '''
+from flask_irc import BotModule
+
+mod = BotModule(%(name)r, __name__)
+
+@mod.event('init')
+def init(state=None):
+    if %(fail)r:
+        raise RuntimeError('broken module')
+    if state:
+        mod.g = state
+    else:
+        mod.g.counter = 0
+
+@mod.command('version %(name)s')
+def version(source, channel):
+    return %(version)r
+'''
+
+
+class ReloadTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        sys.path.insert(0, self.tmpdir)
+        self.name = 'reloadtest_%s' % uuid.uuid4().hex
+        self.path = os.path.join(self.tmpdir, '%s.py' % self.name)
+        self.write_module('1')
+        self.bot = make_bot(IRC_MODULE_REGISTRY={self.name: {'import_name': self.name}})
+        self.assertTrue(self.bot.load_module(self.name))
+        self.module = self.bot.modules[self.name]
+        self.results = []
+
+    def tearDown(self):
+        sys.path.remove(self.tmpdir)
+        shutil.rmtree(self.tmpdir)
+
+    def write_module(self, version, fail=False, code=MODULE_CODE):
+        with open(self.path, 'w') as f:
+            f.write(code % {'name': self.name, 'version': version, 'fail': fail})
+        # The file may be rewritten within the same second
+        for ext in ('.pyc', '.pyo'):
+            if os.path.exists(self.path[:-3] + ext):
+                os.unlink(self.path[:-3] + ext)
+
+    def run_command(self):
+        cmd, args = self.bot._commands.lookup('version %s' % self.name)
+        return cmd(None, '#chan', args)
+
+    def reload(self):
+        self.assertTrue(self.module.reload(self.results.append))
+        deadline = time.time() + 10
+        while not self.results and time.time() < deadline:
+            self.bot.loop.start(pyev.EVRUN_ONCE)
+        self.assertEqual(len(self.results), 1)
+        return self.results[0]
+
+    def test_reload_swaps_module_and_keeps_state(self):
+        self.module.g.counter = 5
+        self.write_module('2')
+        self.assertTrue(self.reload())
+        new_module = self.bot.modules[self.name]
+        self.assertIsNot(new_module, self.module)
+        self.assertEqual(new_module.g.counter, 5)
+        self.assertEqual(self.run_command(), [u'2'])
+        self.assertIs(sys.modules[self.name].mod, new_module)
+
+    def test_failed_init_rolls_back(self):
+        old_pymod = sys.modules[self.name]
+        self.module.g.counter = 3
+        self.write_module('2', fail=True)
+        self.assertFalse(self.reload())
+        self.assertIs(self.bot.modules[self.name], self.module)
+        self.assertEqual(self.module.g.counter, 3)
+        self.assertEqual(self.run_command(), [u'1'])
+        self.assertIs(sys.modules[self.name], old_pymod)
+
+    def test_import_error_keeps_module(self):
+        self.write_module('2', code='this is not python')
+        self.assertFalse(self.reload())
+        self.assertIs(self.bot.modules[self.name], self.module)
+        self.assertEqual(self.run_command(), [u'1'])
+
+    def test_unload_cancels_pending_reload(self):
+        self.write_module('2')
+        self.assertTrue(self.module.reload(self.results.append))
+        self.module.unload()
+        deadline = time.time() + 10
+        while not self.results and time.time() < deadline:
+            self.bot.loop.start(pyev.EVRUN_ONCE)
+        self.assertEqual(self.results, [False])
+        self.assertNotIn(self.name, self.bot.modules)
+        self.assertNotIn('version %s' % self.name, self.bot._commands)
+
+    def test_reload_while_reloading_is_refused(self):
+        self.assertTrue(self.module.reload(self.results.append))
+        self.assertFalse(self.module.reload())
+        deadline = time.time() + 10
+        while not self.results and time.time() < deadline:
+            self.bot.loop.start(pyev.EVRUN_ONCE)
+        self.assertEqual(self.results, [True])
+
+
+if __name__ == '__main__':
+    unittest.main()
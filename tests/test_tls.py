@@ -0,0 +1,111 @@
+import distutils.spawn
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+import pyev
+
+from helpers import make_bot
+
+
+class _TLSServer(threading.Thread):
+    """A local IRC server stand-in accepting one TLS connection"""
+    def __init__(self, certfile, keyfile):
+        super(_TLSServer, self).__init__()
+        self.daemon = True
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.listener.settimeout(10)
+        self.port = self.listener.getsockname()[1]
+        self.lines = []
+        self.error = None
+
+    def run(self):
+        try:
+            conn, _ = self.listener.accept()
+            conn.settimeout(10)
+            conn = ssl.wrap_socket(conn, server_side=True, certfile=self.certfile,
+                                   keyfile=self.keyfile)
+            buf = ''
+            while not any(line.startswith('USER ') for line in self.lines):
+                data = conn.recv(1024)
+                if not data:
+                    return
+                buf += data
+                while '\r\n' in buf:
+                    line, buf = buf.split('\r\n', 1)
+                    self.lines.append(line)
+            conn.sendall(':irc.test 001 FlaskBot :Welcome\r\n')
+            # Keep the connection open until the client is done
+            conn.recv(1024)
+        except (socket.error, ssl.SSLError), e:
+            self.error = e
+        finally:
+            self.listener.close()
+
+
+@unittest.skipUnless(distutils.spawn.find_executable('openssl'), 'openssl is required')
+class TLSTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.certfile = os.path.join(self.tmpdir, 'cert.pem')
+        self.keyfile = os.path.join(self.tmpdir, 'key.pem')
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                                   '-days', '1', '-subj', '/CN=localhost',
+                                   '-addext', 'subjectAltName=DNS:localhost',
+                                   '-keyout', self.keyfile, '-out', self.certfile],
+                                  stdout=devnull, stderr=devnull)
+        self.server = _TLSServer(self.certfile, self.keyfile)
+        self.server.start()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def connect(self, **config):
+        bot = make_bot(IRC_SERVER_HOST='localhost', IRC_SERVER_PORT=self.server.port,
+                       IRC_SERVER_SSL=True, **config)
+        bot._connect()
+        deadline = time.time() + 10
+        while (bot.nick is None and not bot._reconnect_tmr.active and
+                time.time() < deadline):
+            bot.loop.start(pyev.EVRUN_NOWAIT)
+            time.sleep(0.01)
+        return bot
+
+    def test_handshake_and_registration(self):
+        bot = self.connect(IRC_SSL_CA_CERTS=self.certfile)
+        try:
+            self.assertEqual(bot.nick, 'FlaskBot')
+            self.assertIsInstance(bot.sock, ssl.SSLSocket)
+            self.assertFalse(bot._handshaking)
+            self.assertIn('NICK FlaskBot', self.server.lines)
+            self.assertTrue(any(line.startswith('USER ') for line in self.server.lines))
+        finally:
+            bot._close()
+        self.server.join(10)
+        self.assertIsNone(self.server.error)
+
+    def test_untrusted_certificate_is_rejected(self):
+        # The self-signed certificate is not in the default CA store
+        bot = self.connect()
+        try:
+            self.assertIsNone(bot.nick)
+            self.assertIsNone(bot.sock)
+            self.assertTrue(bot._reconnect_tmr.active)
+        finally:
+            bot._close()
+        self.server.join(10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+import itertools
+import socket
+import time
+import unittest
+import uuid
+
+import pyev
+
+from flask_irc import BotModule, ipc
+from flask_irc.bot import _Worker, _worker_index
+from flask_irc.structs import IRCMessage
+from helpers import make_bot
+
+
+def channel_of_worker(index, count):
+    """Returns a channel name routed to the given worker"""
+    for i in itertools.count():
+        channel = '#chan%d' % i
+        if _worker_index(channel, count) == index:
+            return channel
+
+
+class GatewayTest(unittest.TestCase):
+    workers = 3
+
+    def setUp(self):
+        self.bot = make_bot(IRC_WORKERS=self.workers, IRC_WORKER_PARTITION='channel')
+        self.bot.nick = 'FlaskBot'
+        self.bot.isupport = {'CHANTYPES': '#'}
+        self.peers = []
+        for index in xrange(self.workers):
+            sock, peer = socket.socketpair()
+            sock.setblocking(0)
+            worker = _Worker(index, None, sock)
+            worker.watcher = pyev.Io(sock, pyev.EV_READ, self.bot.loop, self.bot._worker_cb,
+                                     worker)
+            worker.watcher.start()
+            self.bot._workers.append(worker)
+            self.peers.append(peer)
+
+    def tearDown(self):
+        for worker in self.bot._workers:
+            worker.watcher.stop()
+            worker.sock.close()
+        for peer in self.peers:
+            peer.close()
+
+    def forwarded(self, line):
+        """Forwards a line and returns the indexes of the workers receiving it"""
+        for worker in self.bot._workers:
+            worker.writebuf = ''
+        self.bot._forward_line(line, IRCMessage(line))
+        receivers = []
+        for worker in self.bot._workers:
+            frames = ipc.FrameReader().feed(worker.writebuf)
+            if frames:
+                self.assertEqual(frames, [(ipc.FRAME_LINE, line)])
+                receivers.append(worker.index)
+        return receivers
+
+    def test_channel_messages_go_to_one_worker(self):
+        for index in xrange(self.workers):
+            channel = channel_of_worker(index, self.workers)
+            self.assertEqual(self.forwarded(':a!b@c PRIVMSG %s :hi' % channel), [index])
+            self.assertEqual(self.forwarded(':a!b@c PART %s' % channel.upper()), [index])
+
+    def test_private_messages_are_partitioned_by_sender(self):
+        index = _worker_index('alice', self.workers)
+        self.assertEqual(self.forwarded(':Alice!a@h PRIVMSG FlaskBot :hi'), [index])
+        self.assertEqual(self.forwarded(':ALICE!a@h NOTICE FlaskBot :hi'), [index])
+
+    def test_other_lines_go_to_all_workers(self):
+        everyone = range(self.workers)
+        self.assertEqual(self.forwarded('PING :irc.example.net'), everyone)
+        self.assertEqual(self.forwarded(':a!b@c QUIT :bye'), everyone)
+        self.assertEqual(self.forwarded(':a!b@c NICK :d'), everyone)
+
+    def test_own_membership_changes_go_to_all_workers(self):
+        channel = channel_of_worker(1, self.workers)
+        everyone = range(self.workers)
+        self.assertEqual(self.forwarded(':FlaskBot!b@c JOIN %s' % channel), everyone)
+        self.assertEqual(self.forwarded(':a!b@c KICK %s FlaskBot :bye' % channel), everyone)
+        self.assertEqual(self.forwarded(':a!b@c JOIN %s' % channel), [1])
+
+    def test_module_partition_sends_everything_to_all_workers(self):
+        self.bot.app.config['IRC_WORKER_PARTITION'] = 'module'
+        everyone = range(self.workers)
+        self.assertEqual(self.forwarded(':a!b@c PRIVMSG #chan :hi'), everyone)
+        self.assertEqual(self.forwarded(':a!b@c PRIVMSG FlaskBot :hi'), everyone)
+
+    def test_worker_output_is_sent_to_the_server(self):
+        irc, server = socket.socketpair()
+        self.addCleanup(server.close)
+        self.bot.sock = irc
+        self.bot.watcher = pyev.Io(irc, pyev.EV_READ, self.bot.loop, self.bot._io_cb)
+        self.bot.watcher.start()
+        expected = 'PRIVMSG #a :1\r\nPRIVMSG #b :2\r\n'
+        data = (ipc.pack_frame(ipc.FRAME_SEND, 'PRIVMSG #a :1\r\n') +
+                ipc.pack_frame(ipc.FRAME_SEND, 'PRIVMSG #b :2\r\n'))
+        # Frames may arrive in pieces
+        self.peers[2].sendall(data[:-3])
+        self.bot.loop.start(pyev.EVRUN_ONCE)
+        self.peers[2].sendall(data[-3:])
+        received = ''
+        server.setblocking(0)
+        deadline = time.time() + 10
+        while len(received) < len(expected) and time.time() < deadline:
+            self.bot.loop.start(pyev.EVRUN_NOWAIT)
+            try:
+                received += server.recv(100)
+            except socket.error:
+                pass
+        self.assertEqual(received, expected)
+        self.bot._close()
+
+    def test_worker_output_is_dropped_while_disconnected(self):
+        self.bot._handle_worker_frame(ipc.FRAME_SEND, 'PRIVMSG #a :1\r\n')
+        self.assertEqual(self.bot._writebuf, '')
+
+
+class WorkerTest(unittest.TestCase):
+    workers = 3
+
+    def setUp(self):
+        self.bot = make_bot(IRC_WORKERS=self.workers, IRC_WORKER_PARTITION='channel')
+        self.bot._worker_id = 1
+        self.bot.isupport = {'CHANTYPES': '#'}
+        self.sock, self.gateway = socket.socketpair()
+        self.bot.sock = self.sock
+        self.bot.watcher = pyev.Io(self.sock, pyev.EV_READ, self.bot.loop,
+                                   self.bot._gateway_cb)
+        self.bot.watcher.start()
+        self.received = []
+        self.module = BotModule('workertest_%s' % uuid.uuid4().hex)
+        self.module.on('PRIVMSG')(self.received.append)
+        self.module.on('JOIN')(self.received.append)
+        self.module.on('QUIT')(self.received.append)
+        self.module.init_bot(self.bot)
+
+    def tearDown(self):
+        self.bot.watcher.stop()
+        self.sock.close()
+        self.gateway.close()
+
+    def receive(self, line):
+        self.bot._handle_gateway_frame(ipc.FRAME_LINE, line)
+
+    def test_modules_handle_lines_routed_to_this_worker(self):
+        channel = channel_of_worker(1, self.workers)
+        self.receive(':a!b@c PRIVMSG %s :hi' % channel)
+        self.assertEqual([msg[0] for msg in self.received], [channel])
+
+    def test_modules_ignore_lines_owned_by_the_first_worker(self):
+        self.receive(':a!b@c QUIT :bye')
+        self.assertEqual(self.received, [])
+
+    def test_connection_state_is_tracked_for_all_lines(self):
+        self.receive(':irc.example.net 001 FlaskBot :Welcome')
+        self.assertEqual(self.bot.nick, 'FlaskBot')
+        channel = channel_of_worker(0, self.workers)
+        self.receive(':FlaskBot!b@c JOIN %s' % channel)
+        self.assertEqual(self.bot.channels, set([channel]))
+        self.assertEqual(self.received, [])
+
+    def test_events_only_reach_modules_of_the_first_worker(self):
+        events = []
+        self.module.event('ready')(lambda: events.append('ready'))
+        self.bot._handle_gateway_frame(ipc.FRAME_EVENT, 'ready')
+        self.assertTrue(self.bot.ready)
+        self.assertEqual(events, [])
+        self.bot._worker_id = 0
+        self.bot._trigger_event('ready')
+        self.assertEqual(events, ['ready'])
+
+    def test_output_is_framed(self):
+        self.bot.send(u'PRIVMSG #chan :caf\xe9')
+        self.bot.stop()
+        self.assertEqual(ipc.FrameReader().feed(self.bot._writebuf),
+                         [(ipc.FRAME_SEND, 'PRIVMSG #chan :caf\xc3\xa9\r\n'),
+                          (ipc.FRAME_STOP, '1')])
+
+
+if __name__ == '__main__':
+    unittest.main()